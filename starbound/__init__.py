@@ -1,5 +1,5 @@
 from .btreedb4 import FileBTreeDB4
-from .sbbf02 import FileSBBF02
+from .sbbf02 import BlockCache, FileSBBF02
 from .sbvj01 import FileSBVJ01
 
 from . import sbon
@@ -8,6 +8,7 @@ from .helpers import (
     open as open_file,
     read_stream,
     CelestialChunks,
+    DecompressingReader,
     FailedWorld,
     KeyStore,
     KeyStoreCompressed,
@@ -0,0 +1,183 @@
+"""Wrappers for using B-tree database files from asyncio code. The blocking
+work (block I/O, decompression and decoding) runs on a shared, bounded thread
+pool, so the files have to be opened in thread-safe mode.
+
+This module requires Python 3.6 or later.
+
+"""
+import asyncio
+import functools
+import os
+import threading
+from concurrent import futures
+
+from . import btreedb4, helpers
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns the thread pool shared by all files that weren't given their
+    own executor, creating it on first use.
+
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = futures.ThreadPoolExecutor(min(32, (os.cpu_count() or 1) + 4))
+        return _executor
+
+
+async def open_file(path, override_extension=None, use_mmap=False, executor=None):
+    """Opens a B-tree database file in thread-safe mode and returns an
+    AsyncWorld for worlds, or an AsyncKeyStore for other B-tree databases.
+    Raises TypeError for other kinds of files (such as players).
+
+    """
+    extension = override_extension or os.path.splitext(path)[1][1:]
+    cls = helpers.EXTENSION_TO_CLASS.get(extension)
+    if cls is not None and not issubclass(cls, btreedb4.FileBTreeDB4):
+        raise TypeError('%s files are not B-tree databases' % cls.__name__)
+
+    executor = executor or get_executor()
+    loop = asyncio.get_event_loop()
+    file = await loop.run_in_executor(executor, functools.partial(
+        helpers.open, path, override_extension, use_mmap, thread_safe=True))
+    if isinstance(file, helpers.World):
+        return AsyncWorld(file, executor)
+    return AsyncKeyStore(file, executor)
+
+
+def set_executor(executor):
+    """Replaces the thread pool shared by all files that weren't given their
+    own executor. The previous pool is not shut down.
+
+    """
+    global _executor
+    with _executor_lock:
+        _executor = executor
+
+
+class AsyncKeyStore(object):
+    """Wraps a B-tree database (such as a Package) with coroutine versions of
+    its lookup methods. Concurrent lookups of the same key share one read.
+
+    """
+    # The number of items read per trip to the executor when iterating.
+    batch_size = 64
+
+    def __init__(self, file, executor=None):
+        if not isinstance(file, btreedb4.FileBTreeDB4):
+            raise TypeError('Expected a FileBTreeDB4, got %s' % type(file).__name__)
+        assert file.thread_safe, 'File must be opened with thread_safe=True'
+        self.file = file
+        self.executor = executor
+
+        # Maps (method name, key) to the future of a lookup that's in progress.
+        self._pending = {}
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.file)
+
+    async def close(self):
+        await self._run(self.file.close)
+
+    async def get(self, key):
+        return await self._coalesce('get', key, self.file.get, key)
+
+    async def get_binary(self, key):
+        return await self._coalesce('get_binary', key, self.file.get_binary, key)
+
+    async def get_many(self, keys):
+        """Returns a list of the deserialized data for the keys, in the same
+        order as the keys. The lookups are batched into a single tree walk.
+
+        """
+        keys = list(keys)
+        return await self._run(lambda: list(self.file.get_many(keys)))
+
+    async def get_raw(self, key):
+        return await self._coalesce('get_raw', key, self.file.get_raw, key)
+
+    async def iter_items(self, start=None, end=None):
+        """Asynchronously yields the key and deserialized data of every item
+        within the range, in key order.
+
+        """
+        async for item in self._iterate(self.file.iter_items(start, end)):
+            yield item
+
+    async def iter_keys(self, start=None, end=None):
+        async for key in self._iterate(self.file.iter_keys(start, end)):
+            yield key
+
+    def _coalesce(self, name, key, function, *args):
+        pending = self._pending
+        future = pending.get((name, key))
+        if future is None:
+            future = asyncio.ensure_future(self._run(function, *args))
+            pending[(name, key)] = future
+            future.add_done_callback(lambda _: pending.pop((name, key), None))
+        # Don't let one cancelled caller cancel the read for everyone else.
+        return asyncio.shield(future)
+
+    async def _iterate(self, iterator):
+        # The iterator is only ever advanced by one thread at a time, since
+        # each batch is awaited before the next is requested.
+        while True:
+            items = await self._run(_take, iterator, self.batch_size)
+            if not items:
+                return
+            for item in items:
+                yield item
+
+    def _run(self, function, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor or get_executor(), function, *args)
+
+
+class AsyncWorld(AsyncKeyStore):
+    """Wraps a World with coroutine versions of its lookup methods.
+
+    """
+    async def get_entities(self, x, y):
+        return await self._coalesce('get_entities', (x, y), self.file.get_entities, x, y)
+
+    async def get_metadata(self):
+        return await self._coalesce('get_metadata', None, self.file.get_metadata)
+
+    async def get_size(self):
+        return await self._coalesce('get_size', None, self.file.get_size)
+
+    async def get_tiles(self, x, y):
+        return await self._coalesce('get_tiles', (x, y), self.file.get_tiles, x, y)
+
+    async def get_tiles_many(self, coords):
+        """Returns a list of the tiles of the regions at the provided (x, y)
+        coordinates, in the same order as the coordinates.
+
+        """
+        return await asyncio.gather(*[self.get_tiles(x, y) for x, y in coords])
+
+    async def iter_regions(self, layer):
+        """Asynchronously yields the x and y coordinates and deserialized data
+        of every region that exists in the provided layer, in key order.
+
+        """
+        async for region in self._iterate(self.file.iter_regions(layer)):
+            yield region
+
+    async def iter_tiles(self):
+        async for region in self._iterate(self.file.iter_tiles()):
+            yield region
+
+
+def _take(iterator, count):
+    items = []
+    for item in iterator:
+        items.append(item)
+        if len(items) >= count:
+            break
+    return items
@@ -1,7 +1,11 @@
+import array
 import binascii
 import bisect
+import collections
 import io
+import os
 import struct
+import tempfile
 
 from . import sbbf02
 from . import sbon
@@ -13,6 +17,19 @@ try:
 except:
     pass
 
+# Python 2.x has no os.replace, but os.rename replaces files on POSIX too.
+try:
+    _replace = os.replace
+except AttributeError:
+    _replace = os.rename
+
+
+KEY_INDEX_SIGNATURE = b'BTIX01'
+# File size, modification time, root node, key size and number of keys.
+KEY_INDEX_HEADER = struct.Struct('>qdiii')
+# Block, offset and length of a value.
+KEY_INDEX_ENTRY = struct.Struct('>iii')
+
 
 class FileBTreeDB4(sbbf02.FileSBBF02):
     """A B-tree database format on top of the SBBF02 block format.
@@ -38,6 +55,53 @@ class FileBTreeDB4(sbbf02.FileSBBF02):
         self.other_root_node = None
         self.other_root_node_is_leaf = None
 
+        # Maps pre-encoded keys to the location of their values, for the root
+        # node the key index was built from (see use_key_index).
+        self._key_index = None
+        self._key_index_root = None
+
+    def build_key_index(self, path=None):
+        """Walks the entire tree and saves the location of every value to a
+        sidecar file, then starts using it for lookups. The path defaults to
+        the path of the database with ".keyindex" added. Raises ValueError if
+        the database isn't a file on disk, since the sidecar couldn't be
+        checked against it later.
+
+        """
+        stat = self._get_file_stat()
+        if stat is None:
+            raise ValueError('A key index needs a database that is a file on disk')
+        path = path or self._get_key_index_path()
+        if path is None:
+            raise ValueError('A path is required for the key index of an unnamed file')
+
+        key_index = dict()
+        for leaf in self._iter_leaves(self.get_block(self.root_node), None, None):
+            for key, block, offset, length in self._iter_leaf_locations(leaf):
+                key_index[key] = (block, offset, length)
+
+        size, mtime = stat
+        data = bytearray(KEY_INDEX_SIGNATURE)
+        data += KEY_INDEX_HEADER.pack(size, mtime, self.root_node, self.key_size, len(key_index))
+        for key in sorted(key_index):
+            data += key
+            data += KEY_INDEX_ENTRY.pack(*key_index[key])
+
+        # Write to a temporary file first so that a crash (or another process
+        # loading the sidecar) never sees a partially written key index.
+        fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                                         dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            _replace(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+
+        self._key_index = key_index
+        self._key_index_root = self.root_node
+
     def commit(self):
         """Alternates the root node.
 
@@ -66,42 +130,48 @@ class FileBTreeDB4(sbbf02.FileSBBF02):
         try:
             return self.deserialize_data(self.get_binary(encoded_key))
         except KeyError:
-            if encoded_key == key:
-                raise KeyError(binascii.hexlify(key))
-            else:
-                raise KeyError(key, binascii.hexlify(encoded_key))
+            raise self._key_error(key, encoded_key)
 
     def get_binary(self, key):
-        """Returns the binary data for the provided pre-encoded key.
+        """Returns the binary data (as bytes) for the provided pre-encoded key.
 
         """
-        assert len(key) == self.key_size, 'Invalid key length'
+        stream, length = self._find_value(key)
+        return stream.read_value(length)
 
-        block = self.get_block(self.root_node)
+    def get_binary_chunks(self, key):
+        """Returns an iterator of memoryview chunks that make up the binary
+        data for the provided pre-encoded key, without assembling the value.
+        Useful for feeding a value to something like zlib.decompressobj.
 
-        # Scan down the B-tree until we reach a leaf.
-        while isinstance(block, BTreeIndex):
-            block_number = block.get_block_for_key(key)
-            block = self.get_block(block_number)
-        assert isinstance(block, BTreeLeaf), 'Did not reach a leaf'
+        """
+        stream, length = self._find_value(key)
+        return stream.iter_chunks(length)
 
-        return self.get_leaf_value(block, key)
+    def get_binary_many(self, keys):
+        """Returns a dict of the binary data for the provided pre-encoded keys.
+        Keys that don't exist are left out of the result. The B-tree is only
+        descended once, so each block is read at most once.
+
+        """
+        return dict(self.iter_binary_many(keys))
 
     def get_leaf_value(self, leaf, key):
-        stream = LeafReader(self, leaf)
+        stream, length = self._find_in_leaf(leaf, key)
+        return stream.read_value(length)
 
-        # The number of keys is read on-demand because only leaves pointed to
-        # by an index contain this number (others just contain arbitrary data).
-        num_keys, = struct.unpack('>i', stream.read(4))
-        assert num_keys < 1000, 'Leaf had unexpectedly high number of keys'
-        for i in range(num_keys):
-            cur_key = stream.read(self.key_size)
-            value = sbon.read_bytes(stream)
+    def get_many(self, keys):
+        """Returns a generator of the deserialized data for each of the provided
+        keys, in the same order as the keys. The values are read in key order,
+        and only the ones that are read before their turn are held in memory.
+        Raises KeyError for the first missing key.
 
-            if cur_key == key:
-                return value
-
-        raise KeyError(key)
+        """
+        keys = list(keys)
+        encoded_keys = [self.encode_key(key) for key in keys]
+        for encoded_key in encoded_keys:
+            assert len(encoded_key) == self.key_size, 'Invalid key length'
+        return self._iter_many(keys, encoded_keys)
 
     def get_raw(self, key):
         """Returns the raw data for the provided key.
@@ -115,6 +185,53 @@ class FileBTreeDB4(sbbf02.FileSBBF02):
         """
         return self.deserialize_data(self.get_binary(key))
 
+    def iter_binary_items(self, start=None, end=None, other_root=False):
+        """Yields the pre-encoded key and binary data of every entry in the
+        database in key order. The range can be limited by start (inclusive)
+        and end (exclusive) pre-encoded keys. If other_root is True, the tree
+        under the other (non-active) root node is read instead.
+
+        """
+        root_node = self.other_root_node if other_root else self.root_node
+        for item in self._iter_block_items(self.get_block(root_node), start, end):
+            yield item
+
+    def iter_binary_many(self, keys):
+        """Yields the pre-encoded key and binary data of each of the provided
+        pre-encoded keys that exist, in key order. Only the leaves that may
+        contain the keys are read, and other values in them are skipped.
+
+        """
+        keys = sorted(set(keys))
+        for key in keys:
+            assert len(key) == self.key_size, 'Invalid key length'
+
+        if keys:
+            for item in self._iter_values(self.get_block(self.root_node), keys):
+                yield item
+
+    def iter_items(self, start=None, end=None, other_root=False):
+        """Yields the pre-encoded key and deserialized data of every entry in
+        the database in key order. See iter_binary_items for the arguments.
+
+        """
+        for key, value in self.iter_binary_items(start, end, other_root):
+            yield key, self.deserialize_data(value)
+
+    def iter_keys(self, start=None, end=None, other_root=False):
+        """Yields every pre-encoded key in the database in key order. See
+        iter_binary_items for the arguments.
+
+        """
+        for key, _ in self.iter_binary_items(start, end, other_root):
+            yield key
+
+    def iter_leaf(self, leaf):
+        """Yields the key and binary data of every entry in the provided leaf.
+
+        """
+        return self._iter_leaf_values(leaf)
+
     def initialize(self):
         super(FileBTreeDB4, self).initialize()
         stream = self.get_user_header()
@@ -138,31 +255,340 @@ class FileBTreeDB4(sbbf02.FileSBBF02):
             self.root_node, self.root_node_is_leaf = fields[2:4]
             self.other_root_node, self.other_root_node_is_leaf = fields[4:6]
 
+    def load_key_index(self, path=None):
+        """Starts using the key index sidecar file created by build_key_index
+        for lookups. Returns False (and leaves the key index unused) if the
+        sidecar is missing, truncated or was built for a different version of
+        the file, or if the database isn't a file on disk.
+
+        """
+        stat = self._get_file_stat()
+        path = path or self._get_key_index_path()
+        if stat is None or path is None:
+            return False
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return False
+
+        offset = len(KEY_INDEX_SIGNATURE)
+        if data[:offset] != KEY_INDEX_SIGNATURE:
+            return False
+        if len(data) < offset + KEY_INDEX_HEADER.size:
+            return False
+
+        size, mtime, root_node, key_size, num_keys = KEY_INDEX_HEADER.unpack_from(data, offset)
+        if (size, mtime) != stat or root_node != self.root_node:
+            return False
+        if key_size != self.key_size:
+            return False
+        offset += KEY_INDEX_HEADER.size
+
+        entry_size = key_size + KEY_INDEX_ENTRY.size
+        if num_keys < 0 or len(data) != offset + num_keys * entry_size:
+            return False
+
+        key_index = dict()
+        for i in range(num_keys):
+            key = data[offset:offset + key_size]
+            key_index[key] = KEY_INDEX_ENTRY.unpack_from(data, offset + key_size)
+            offset += entry_size
+
+        self._key_index = key_index
+        self._key_index_root = root_node
+        return True
+
+    def scan(self, start_key=None, end_key=None):
+        """Yields the pre-encoded key and deserialized data of every entry from
+        start_key (inclusive) to end_key (exclusive) in key order. The keys
+        are encoded first, so this only makes sense for databases where key
+        encoding preserves order.
+
+        """
+        start = None if start_key is None else self.encode_key(start_key)
+        end = None if end_key is None else self.encode_key(end_key)
+        return self.iter_items(start, end)
+
+    def scan_prefix(self, prefix):
+        """Yields the pre-encoded key and deserialized data of every entry
+        whose pre-encoded key starts with the provided prefix.
+
+        """
+        # The end of the range is the smallest value that is greater than all
+        # keys with the prefix.
+        end = bytearray(prefix.rstrip(b'\xFF'))
+        if end:
+            end[-1] += 1
+            end = bytes(end)
+        else:
+            end = None
+        return self.iter_items(prefix, end)
+
+    def use_key_index(self, path=None):
+        """Loads the key index sidecar file for the database, or builds it if
+        it's missing or out of date. Lookups with get_binary (and the methods
+        that use it) then go straight to the leaf that contains the value.
+        The key index is ignored while a different root node is active.
+
+        """
+        if not self.load_key_index(path):
+            self.build_key_index(path)
+
+    def _find_in_leaf(self, leaf, key):
+        """Returns a LeafReader positioned at the start of the value for the
+        provided pre-encoded key in the leaf, and the length of the value.
+
+        """
+        stream = LeafReader(self, leaf)
+
+        # The number of keys is read on-demand because only leaves pointed to
+        # by an index contain this number (others just contain arbitrary data).
+        num_keys, = struct.unpack('>i', stream.read(4))
+        assert num_keys < 1000, 'Leaf had unexpectedly high number of keys'
+        for i in range(num_keys):
+            cur_key = stream.read(self.key_size)
+            length = sbon.read_varlen_number(stream)
+            if cur_key == key:
+                return stream, length
+            stream.skip(length)
+
+        raise KeyError(key)
+
+    def _find_value(self, key):
+        """Returns a LeafReader positioned at the start of the value for the
+        provided pre-encoded key, and the length of the value.
+
+        """
+        assert len(key) == self.key_size, 'Invalid key length'
+
+        if self._key_index is not None and self._key_index_root == self.root_node:
+            if key not in self._key_index:
+                raise KeyError(key)
+            block, offset, length = self._key_index[key]
+            return LeafReader(self, self.get_block(block), offset), length
+
+        block = self.get_block(self.root_node)
+
+        # Scan down the B-tree until we reach a leaf.
+        while isinstance(block, BTreeIndex):
+            block_number = block.get_block_for_key(key)
+            block = self.get_block(block_number)
+        assert isinstance(block, BTreeLeaf), 'Did not reach a leaf'
+
+        return self._find_in_leaf(block, key)
+
+    def _get_file_stat(self):
+        """Returns the size and modification time of the database file, or
+        None if the stream isn't backed by a file (such as a BytesIO).
+
+        """
+        try:
+            fileno = self._stream.fileno()
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+        stat = os.fstat(fileno)
+        return stat.st_size, stat.st_mtime
+
+    def _get_key_index_path(self):
+        name = getattr(self._stream, 'name', None)
+        if name is None or isinstance(name, int):
+            # Streams opened from a file descriptor have an int name.
+            return None
+        return name + (b'.keyindex' if isinstance(name, bytes) else u'.keyindex')
+
+    def _iter_block_items(self, block, start, end):
+        """Yields the entries in the subtree of the provided block that are
+        within the range. Only the path to the current leaf is kept in memory.
+
+        """
+        for leaf in self._iter_leaves(block, start, end):
+            for item in self._iter_leaf_values(leaf, start, end):
+                yield item
+
+    def _iter_leaf_locations(self, leaf):
+        """Yields the key, and the block, offset and length of the value, for
+        every entry in the provided leaf.
+
+        """
+        stream = LeafReader(self, leaf)
+        num_keys, = struct.unpack('>i', stream.read(4))
+        assert num_keys < 1000, 'Leaf had unexpectedly high number of keys'
+        for i in range(num_keys):
+            cur_key = stream.read(self.key_size)
+            length = sbon.read_varlen_number(stream)
+            block, offset = stream.tell()
+            stream.skip(length)
+            yield cur_key, block, offset, length
+
+    def _iter_leaf_values(self, leaf, start=None, end=None, keys=None):
+        """Yields the key and binary data of the entries in the provided leaf
+        that are within the range and (if provided) in keys. The values of any
+        other entries are skipped without being read.
+
+        """
+        stream = LeafReader(self, leaf)
+
+        # The number of keys is read on-demand because only leaves pointed to
+        # by an index contain this number (others just contain arbitrary data).
+        num_keys, = struct.unpack('>i', stream.read(4))
+        assert num_keys < 1000, 'Leaf had unexpectedly high number of keys'
+        for i in range(num_keys):
+            cur_key = stream.read(self.key_size)
+            if end is not None and cur_key >= end:
+                return
+            length = sbon.read_varlen_number(stream)
+            if (start is not None and cur_key < start) or (keys is not None and cur_key not in keys):
+                stream.skip(length)
+                continue
+            yield cur_key, stream.read_value(length)
+
+    def _iter_leaves(self, block, start, end):
+        """Yields the leaves in the subtree of the provided block that may
+        contain keys within the range, in key order.
+
+        """
+        if isinstance(block, BTreeIndex):
+            first = 0 if start is None else block.bisect_right(start)
+            last = block.num_keys if end is None else block.bisect_left(end)
+            for i in range(first, last + 1):
+                for leaf in self._iter_leaves(self.get_block(block.values[i]), start, end):
+                    yield leaf
+            return
+
+        assert isinstance(block, BTreeLeaf), 'Did not reach a leaf'
+        yield block
+
+    def _iter_many(self, keys, encoded_keys):
+        # Count the keys so that values asked for more than once are only let
+        # go of after their last use.
+        uses = collections.Counter(encoded_keys)
+        held = dict()
+        items = self.iter_binary_many(encoded_keys)
+        for key, encoded_key in zip(keys, encoded_keys):
+            while encoded_key not in held:
+                item = next(items, None)
+                # Keys come out of the tree in order, so if a greater key comes
+                # out first, this one doesn't exist.
+                if item is None or item[0] > encoded_key:
+                    raise self._key_error(key, encoded_key)
+                held[item[0]] = item[1]
+
+            value = held[encoded_key]
+            uses[encoded_key] -= 1
+            if not uses[encoded_key]:
+                del held[encoded_key]
+            yield self.deserialize_data(value)
+
+    def _iter_values(self, block, keys):
+        """Yields the key and binary data of each of the sorted keys that exist
+        in the subtree of the provided block, in key order.
+
+        """
+        if isinstance(block, BTreeIndex):
+            start = 0
+            while start < len(keys):
+                # Group all the keys that belong to the same child block.
+                i = block.bisect_right(keys[start])
+                if i < block.num_keys:
+                    end = bisect.bisect_left(keys, block.get_key(i), start)
+                else:
+                    end = len(keys)
+                for item in self._iter_values(self.get_block(block.values[i]), keys[start:end]):
+                    yield item
+                start = end
+            return
+
+        assert isinstance(block, BTreeLeaf), 'Did not reach a leaf'
+        remaining = set(keys)
+        for item in self._iter_leaf_values(block, keys=remaining):
+            yield item
+            remaining.discard(item[0])
+            if not remaining:
+                return
+
+    def _key_error(self, key, encoded_key):
+        if encoded_key == key:
+            return KeyError(binascii.hexlify(key))
+        else:
+            return KeyError(key, binascii.hexlify(encoded_key))
+
 
 class BTreeIndex(sbbf02.Block):
+    """An index block. The keys are kept back to back in a single bytes object
+    and the child block pointers in an array, with values[i] pointing to the
+    block of keys less than key i (and the last value to the rest).
+
+    """
     SIGNATURE = b'II'
 
-    __slots__ = ['keys', 'level', 'num_keys', 'values']
+    __slots__ = ['key_data', 'key_size', 'level', 'num_keys', 'values']
 
     def __init__(self, file, block_index):
         self.level, self.num_keys, left_block = struct.unpack('>Bii', file.read(9))
+        self.key_size = file.key_size
 
-        self.keys = []
-        self.values = [left_block]
+        # Subtract 11 for signature, level, number of keys and left block.
+        max_keys = (file.block_size - 11) // (self.key_size + 4)
+        if not 0 <= self.num_keys <= max_keys:
+            if not file.repair:
+                raise ValueError('Index had invalid number of keys %d' % self.num_keys)
+            self.num_keys = min(max(self.num_keys, 0), max_keys)
 
-        for i in range(self.num_keys):
-            key = file.read(file.key_size)
-            block, = struct.unpack('>i', file.read(4))
+        # Unpack all the entries at once and split them into keys and values.
+        entry_format = '%dsi' % self.key_size
+        data = file.read(self.num_keys * (self.key_size + 4))
+        entries = struct.unpack('>' + entry_format * self.num_keys, data)
 
-            self.keys.append(key)
-            self.values.append(block)
+        self.key_data = b''.join(entries[0::2])
+        self.values = array.array('i', (left_block,))
+        self.values.extend(entries[1::2])
 
     def __str__(self):
         return 'Index(level={}, num_keys={})'.format(self.level, self.num_keys)
 
+    @property
+    def keys(self):
+        return [self.get_key(i) for i in range(self.num_keys)]
+
+    def bisect_left(self, key):
+        """Returns the position of the first key that is not less than the
+        provided key, like bisect.bisect_left on a list of the keys.
+
+        """
+        data, size = self.key_data, self.key_size
+        lo, hi = 0, self.num_keys
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            start = mid * size
+            if data[start:start + size] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def bisect_right(self, key):
+        """Returns the position of the first key that is greater than the
+        provided key, like bisect.bisect_right on a list of the keys.
+
+        """
+        data, size = self.key_data, self.key_size
+        lo, hi = 0, self.num_keys
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            start = mid * size
+            if key < data[start:start + size]:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
     def get_block_for_key(self, key):
-        i = bisect.bisect_right(self.keys, key)
-        return self.values[i]
+        return self.values[self.bisect_right(key)]
+
+    def get_key(self, i):
+        return self.key_data[i * self.key_size:(i + 1) * self.key_size]
 
 
 class BTreeLeaf(sbbf02.Block):
@@ -172,7 +598,7 @@ class BTreeLeaf(sbbf02.Block):
 
     def __init__(self, file, block_index):
         # Substract 6 for signature and next_block.
-        self.data = file.read(file.block_size - 6)
+        self.data = file.read_view(file.block_size - 6)
 
         value, = struct.unpack('>i', file.read(4))
         self.next_block = value if value != -1 else None
@@ -199,55 +625,145 @@ class LeafReader(object):
     """
     __slots__ = ['_file', '_leaf', '_offset', '_visited']
 
-    def __init__(self, file, leaf):
+    def __init__(self, file, leaf, offset=0):
         assert isinstance(file, FileBTreeDB4), 'File is not a FileBTreeDB4 instance'
         assert isinstance(leaf, BTreeLeaf), 'Leaf is not a BTreeLeaf instance'
 
         self._file = file
         self._leaf = leaf
-        self._offset = 0
-        self._visited = [leaf.index]
+        self._offset = offset
+        self._visited = set([leaf.index])
 
     def read(self, length):
         offset = self._offset
 
         if offset + length <= len(self._leaf.data):
             self._offset += length
-            return self._leaf.data[offset:offset + length]
+            data = self._leaf.data[offset:offset + length]
+            # Leaves of memory mapped files are views that need to be copied.
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            return data
 
-        buffer = io.BytesIO()
+        return self.read_value(length)
 
-        # If the file is in repair mode, make the buffer available globally.
-        if self._file.repair:
-            LeafReader.last_buffer = buffer
+    def iter_chunks(self, length):
+        """Yields memoryview slices of the leaves that make up the next length
+        bytes, without copying any data.
 
-        # Exhaust current leaf.
-        num_read = buffer.write(self._leaf.data[offset:])
-        length -= num_read
+        """
+        while True:
+            data = self._leaf.data
+            offset = self._offset
+            end = min(offset + length, len(data))
+            if end > offset:
+                yield memoryview(data)[offset:end]
+            self._offset = end
+            length -= end - offset
+            if not length:
+                return
+            self._next_leaf()
+
+    def read_value(self, length):
+        """Reads the next length bytes and returns them as bytes. A value that
+        spans several leaves is copied into a bytearray that is allocated up
+        front, rather than being joined from pieces.
 
-        # Keep moving onto the next leaf until we have read the desired amount.
-        while length > 0:
-            next_block = self._leaf.next_block
+        """
+        buffer = None
+        filled = 0
+        try:
+            for chunk in self.iter_chunks(length):
+                if buffer is None:
+                    if len(chunk) == length:
+                        # Values within a single leaf only need to be copied
+                        # once. Keep iterating so the reader moves past it.
+                        buffer = chunk.tobytes()
+                        filled = length
+                        continue
+                    buffer = bytearray(length)
+                buffer[filled:filled + len(chunk)] = chunk
+                filled += len(chunk)
+        finally:
+            # If the file is in repair mode, make the data available globally.
+            if self._file.repair:
+                LeafReader.last_buffer = io.BytesIO(bytes(buffer[:filled] if buffer else b''))
+        if buffer is None:
+            return b''
+        return bytes(buffer)
+
+    def skip(self, length):
+        """Moves past the next length bytes without returning them. Leaves that
+        lie entirely within the skipped bytes are not loaded; only their next
+        block pointer is read.
 
-            assert next_block is not None, 'Tried to read too far'
-            assert next_block not in self._visited, 'Tried to read visited block'
-            self._visited.append(next_block)
+        """
+        offset = self._offset + length
+        leaf_size = len(self._leaf.data)
+        if offset <= leaf_size:
+            self._offset = offset
+            return
 
-            self._leaf = self._file.get_block(next_block)
-            if self._file.repair and isinstance(self._leaf, sbbf02.BlockFree):
-                self._leaf = BTreeRestoredLeaf(self._leaf)
+        if self._file.repair:
+            # Skipped leaves may have to be restored from free blocks.
+            for _ in self.iter_chunks(length):
+                pass
+            return
+
+        next_block = self._leaf.next_block
+        offset -= leaf_size
+        # All leaves hold the same amount of data.
+        leaf_size = self._file.block_size - 6
+        while offset > leaf_size:
+            self._visit(next_block)
+            next_block = self._read_next_block(next_block)
+            offset -= leaf_size
+
+        self._load_leaf(next_block)
+        self._offset = offset
+
+    def tell(self):
+        """Returns the index of the current block and the offset in its data.
 
-            assert isinstance(self._leaf, BTreeLeaf), \
-                'Leaf pointed to non-leaf %s after reading %d byte(s)' % (
-                        next_block, buffer.tell())
+        """
+        return self._leaf.index, self._offset
 
-            num_read = buffer.write(self._leaf.data[:length])
-            length -= num_read
+    def _load_leaf(self, block_index):
+        self._visit(block_index)
 
-        # The new offset will be how much was read from the current leaf.
-        self._offset = num_read
+        self._leaf = self._file.get_block(block_index)
+        if self._file.repair and isinstance(self._leaf, sbbf02.BlockFree):
+            self._leaf = BTreeRestoredLeaf(self._leaf)
 
-        data = buffer.getvalue()
-        buffer.close()
+        assert isinstance(self._leaf, BTreeLeaf), \
+            'Leaf pointed to non-leaf %s' % block_index
 
-        return data
+    def _next_leaf(self):
+        self._load_leaf(self._leaf.next_block)
+        self._offset = 0
+
+    def _read_next_block(self, block_index):
+        """Returns the next block pointer of a leaf without loading the leaf,
+        unless it's already in the block cache.
+
+        """
+        file = self._file
+        cache = file.block_cache
+        if cache is not None and block_index in cache:
+            # The block may have been evicted by another thread since.
+            found, leaf = cache.get(block_index)
+            if found:
+                assert isinstance(leaf, BTreeLeaf), \
+                    'Leaf pointed to non-leaf %s' % block_index
+                return leaf.next_block
+
+        signature = file.read_block_data(block_index, 0, 2)
+        assert signature == BTreeLeaf.SIGNATURE, \
+            'Leaf pointed to non-leaf %s' % block_index
+        value, = struct.unpack('>i', file.read_block_data(block_index, file.block_size - 4, 4))
+        return value if value != -1 else None
+
+    def _visit(self, block_index):
+        assert block_index is not None, 'Tried to read too far'
+        assert block_index not in self._visited, 'Tried to read visited block'
+        self._visited.add(block_index)
@@ -1,8 +1,14 @@
 import binascii
+import collections
+import errno
+import fnmatch
 import hashlib
 import io
+import multiprocessing
 import os
 import struct
+import threading
+import time
 import zlib
 
 from . import btreedb4
@@ -14,6 +20,11 @@ try:
 except:
     import __builtin__ as builtins
 
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
 # Override range with xrange when running Python 2.x.
 try:
     range = xrange
@@ -21,11 +32,138 @@ except:
     pass
 
 
+class DecompressingReader(io.RawIOBase):
+    """A read-only stream that inflates zlib compressed data from an iterator
+    of chunks as it's being read. Only seeking forward is supported. Raises
+    zlib.error if the chunks end before the compressed data does.
+
+    """
+    def __init__(self, chunks, buffer_size=io.DEFAULT_BUFFER_SIZE):
+        super(DecompressingReader, self).__init__()
+        self._buffer_size = buffer_size
+        self._chunks = iter(chunks)
+        self._decompressor = zlib.decompressobj()
+        self._finished = False
+        self._pending = b''
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        decompressor = self._decompressor
+        size = len(b)
+        while not self._pending and not self._finished:
+            data = decompressor.unconsumed_tail
+            if not data:
+                data = next(self._chunks, None)
+                if data is None:
+                    self._pending = self._finish()
+                    self._finished = True
+                    break
+                if bytes is str and isinstance(data, memoryview):
+                    # Python 2.x decompressors don't accept memoryviews.
+                    data = data.tobytes()
+            # Limit how much is inflated at a time to keep memory use down.
+            self._pending = decompressor.decompress(data, max(size, self._buffer_size))
+
+        data = self._pending[:size]
+        self._pending = self._pending[size:]
+        b[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('Can only seek from the start or current position')
+        if offset < self._position:
+            raise io.UnsupportedOperation('Can only seek forward')
+
+        while self._position < offset:
+            if not self.read(min(offset - self._position, self._buffer_size)):
+                break
+        return self._position
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def _finish(self):
+        """Returns the rest of the decompressed data once every chunk has been
+        passed to the decompressor, or raises zlib.error if the compressed
+        data was cut short.
+
+        """
+        decompressor = self._decompressor
+        if hasattr(decompressor, 'eof'):
+            data = decompressor.flush()
+            if not decompressor.eof:
+                raise zlib.error('Compressed data ended unexpectedly')
+            return data
+
+        # Python 2.x decompressors have no eof attribute, but input that comes
+        # after the end of the compressed data is left in unused_data.
+        probe = decompressor.copy()
+        try:
+            probe.decompress(b'\x00')
+        except zlib.error:
+            pass
+        if not probe.unused_data:
+            raise zlib.error('Compressed data ended unexpectedly')
+        return decompressor.flush()
+
+
 class KeyStore(btreedb4.FileBTreeDB4):
     """A B-tree database that uses SHA-256 hashes for key lookup.
 
     """
+    def __init__(self, stream):
+        super(KeyStore, self).__init__(stream)
+
+        # Set this attribute to change how many recently used keys have their
+        # hashes remembered. Keys passed to encode_keys are always remembered.
+        self.key_cache_size = 4096
+
+        self._key_cache = collections.OrderedDict()
+        self._key_lock = threading.Lock()
+        self._key_table = {}
+
     def encode_key(self, key):
+        encoded_key = self._key_table.get(key)
+        if encoded_key is not None:
+            return encoded_key
+
+        cache = self._key_cache
+        with self._key_lock:
+            encoded_key = cache.pop(key, None)
+            if encoded_key is not None:
+                cache[key] = encoded_key
+                return encoded_key
+
+        encoded_key = self._hash_key(key)
+        if not self.key_cache_size:
+            return encoded_key
+
+        with self._key_lock:
+            while len(cache) >= self.key_cache_size:
+                cache.popitem(last=False)
+            cache[key] = encoded_key
+        return encoded_key
+
+    def encode_keys(self, keys):
+        """Encodes all of the keys and remembers the hashes for as long as the
+        file is open. Returns a dict of key to encoded key.
+
+        """
+        table = dict((key, self._hash_key(key)) for key in keys)
+        self._key_table.update(table)
+        return table
+
+    def _hash_key(self, key):
         return hashlib.sha256(key.encode('utf-8')).digest()
 
 
@@ -37,6 +175,27 @@ class KeyStoreCompressed(KeyStore):
     def deserialize_data(self, data):
         return zlib.decompress(data)
 
+    def deserialize_stream(self, stream):
+        """Can be overridden to deserialize data from a stream of the inflated
+        data (see get_streamed).
+
+        """
+        return stream.read()
+
+    def get_stream(self, key):
+        """Returns a file-like object that inflates the data for the provided
+        key as it's read, one leaf at a time.
+
+        """
+        return _open_compressed(self, key)
+
+    def get_streamed(self, key):
+        """Like get, but deserializes the data while it's being inflated, so the
+        entire inflated (or compressed) data is never in memory at once.
+
+        """
+        return self.deserialize_stream(self.get_stream(key))
+
 
 class CelestialChunks(KeyStoreCompressed):
     def deserialize_data(self, data):
@@ -44,6 +203,9 @@ class CelestialChunks(KeyStoreCompressed):
         stream = io.BytesIO(data)
         return sbon.read_document(stream)
 
+    def deserialize_stream(self, stream):
+        return sbon.read_document(stream)
+
     def initialize(self):
         super(CelestialChunks, self).initialize()
         assert self.identifier == 'Celestial2', 'Unsupported celestial chunks file'
@@ -60,8 +222,41 @@ class Package(KeyStore):
         super(Package, self).__init__(path)
         self._index = None
 
-    def encode_key(self, key):
-        return super(Package, self).encode_key(key.lower())
+    def extract_all(self, directory, workers=None, filter=None, progress=None):
+        """Writes every file in the package (or only the paths that match the
+        glob pattern in filter) to the directory. The database is read once in
+        key order, skipping the values of other files, and the files are
+        written by a pool of worker threads, with a limited number of files
+        waiting to be written.
+
+        If provided, progress is called after each file with the number of
+        files written, the total number of files, the number of bytes written
+        and the number of seconds elapsed. Returns a dict with the number of
+        files and bytes written, the seconds elapsed and any missing paths.
+
+        """
+        paths = self.get_index()
+        if filter:
+            paths = fnmatch.filter(paths, filter)
+
+        key_to_path = dict((self.encode_key(path), path) for path in paths)
+
+        def iter_files():
+            for key, data in self.iter_binary_many(list(key_to_path)):
+                path = key_to_path.pop(key)
+                yield _get_extract_path(directory, path), data
+
+        start = time.time()
+        stats = dict(files=0, bytes=0)
+        for size in _map_ordered(_write_file, iter_files(), workers, False, None):
+            stats['files'] += 1
+            stats['bytes'] += size
+            if progress:
+                progress(stats['files'], len(paths), stats['bytes'], time.time() - start)
+
+        stats['seconds'] = time.time() - start
+        stats['missing'] = sorted(key_to_path.values())
+        return stats
 
     def get_digest(self):
         return self.get(Package.DIGEST_KEY)
@@ -76,8 +271,14 @@ class Package(KeyStore):
         elif self.identifier == 'Assets2':
             self._index = sbon.read_string_digest_map(stream)
 
+        # Every path in the package is likely to be looked up, so hash them all
+        # up front instead of on each lookup.
+        self.encode_keys(self._index)
         return self._index
 
+    def _hash_key(self, key):
+        return super(Package, self)._hash_key(key.lower())
+
 
 class VariantDatabase(KeyStoreCompressed):
     """A B-tree database where each key is a SHA-256 hash and the value is
@@ -89,6 +290,9 @@ class VariantDatabase(KeyStoreCompressed):
         stream = io.BytesIO(data)
         return sbon.read_dynamic(stream)
 
+    def deserialize_stream(self, stream):
+        return sbon.read_dynamic(stream)
+
     def encode_key(self, key):
         # TODO: The key encoding for this may be SBON-encoded SHA-256 hash.
         return super(VariantDatabase, self).encode_key(key)
@@ -127,6 +331,9 @@ class World(btreedb4.FileBTreeDB4):
         self._metadata = None
         self._metadata_version = None
 
+    def decode_key(self, key):
+        return struct.unpack('>BHH', key)
+
     def deserialize_data(self, data):
         return zlib.decompress(data)
 
@@ -154,16 +361,119 @@ class World(btreedb4.FileBTreeDB4):
 
         return data, version
 
+    def get_size(self):
+        """Returns the width and height of the world in tiles.
+
+        """
+        metadata, version = self.get_metadata()
+        if version == 1:
+            return tuple(metadata['planet']['size'])
+        return tuple(metadata['worldTemplate']['size'])
+
+    def get_stream(self, key):
+        """Returns a file-like object that inflates the data for the provided
+        key as it's read, one leaf at a time.
+
+        """
+        return _open_compressed(self, key)
+
     def get_tiles(self, x, y):
-        stream = io.BytesIO(self.get((1, x, y)))
-        unknown = stream.read(3)
-        # There are 1024 (32x32) tiles in a region.
-        return [sbon.read_tile(stream) for _ in range(World.TILES_PER_REGION)]
+        return self._read_tiles(self.get((1, x, y)))
+
+    def get_tiles_parallel(self, coords, workers=None, processes=False, window=None):
+        """Yields the tiles of the regions at the provided (x, y) coordinates, in
+        the same order as the coordinates. The data is read in the calling
+        thread, while decompression and decoding happen in a pool of worker
+        threads (or processes, if processes is True). At most window regions
+        (twice the number of workers by default) are in flight at a time.
+
+        """
+        values = (self.get_raw((1, x, y)) for x, y in coords)
+        return _map_ordered(_decode_tiles, values, workers, processes, window)
+
+    def get_tiles_array(self, x, y):
+        """Returns the tiles of a region as a NumPy structured array with the
+        same fields as sbon.Tile. The array is a read-only view over the
+        decompressed region data. Requires NumPy.
+
+        """
+        return sbon.read_tiles_array(self.get((1, x, y)), World.TILES_PER_REGION, 3)
 
     def initialize(self):
         super(World, self).initialize()
         assert self.identifier == 'World2', 'Tried to open non-world BTreeDB4 file'
 
+    def load_tile_grid(self, fields=None, fill=None, directory=None):
+        """Returns a dict of NumPy arrays with the shape (height, width) of the
+        world, one for each of the provided sbon.Tile fields (all of them by
+        default). Tiles in missing regions are set to fill, which defaults to
+        all bits set (-1 for signed fields) or False for boolean fields.
+
+        If a directory is provided, the arrays will be memory mapped .npy files
+        in that directory, named after the fields. Requires NumPy.
+
+        """
+        numpy = sbon.numpy
+        if numpy is None:
+            raise ImportError('NumPy is required to load a tile grid')
+
+        width, height = self.get_size()
+
+        grids = dict()
+        for field in fields or sbon.Tile._fields:
+            dtype = sbon.TILE_DTYPE[field].newbyteorder('=')
+            if directory:
+                path = os.path.join(directory, field + '.npy')
+                grid = numpy.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                                    shape=(height, width))
+            else:
+                grid = numpy.empty((height, width), dtype)
+
+            if fill is not None:
+                grid.fill(fill)
+            elif dtype.kind == 'b':
+                grid.fill(False)
+            else:
+                grid.fill(numpy.iinfo(dtype).max if dtype.kind == 'u' else -1)
+
+            grids[field] = grid
+
+        for x, y, data in self.iter_regions(1):
+            left, top = x * World.TILES_X, y * World.TILES_Y
+            # Regions along the edges may extend past the size of the world.
+            region_width = min(World.TILES_X, width - left)
+            region_height = min(World.TILES_Y, height - top)
+            if region_width <= 0 or region_height <= 0:
+                continue
+
+            tiles = sbon.read_tiles_array(data, World.TILES_PER_REGION, 3)
+            tiles = tiles.reshape(World.TILES_Y, World.TILES_X)
+            for field, grid in grids.items():
+                grid[top:top + region_height, left:left + region_width] = \
+                    tiles[field][:region_height, :region_width]
+
+        return grids
+
+    def iter_regions(self, layer):
+        """Yields the x and y coordinates and deserialized data of every region
+        that exists in the provided layer, in key order.
+
+        """
+        for key, data in self.scan_prefix(struct.pack('>B', layer)):
+            _, x, y = self.decode_key(key)
+            yield x, y, data
+
+    def iter_tiles(self):
+        """Yields the x and y coordinates and tiles of every region that exists
+        in the world.
+
+        """
+        for x, y, data in self.iter_regions(1):
+            yield x, y, self._read_tiles(data)
+
+    def _read_tiles(self, data):
+        return _read_tiles(data)
+
 
 class FailedWorld(World):
     def __init__(self, stream):
@@ -189,6 +499,71 @@ class FailedWorld(World):
         return data, version
 
 
+def _decode_tiles(data):
+    return _read_tiles(zlib.decompress(data))
+
+def _get_extract_path(directory, path):
+    parts = path.lstrip('/').split('/')
+    if '..' in parts:
+        raise ValueError('Unsafe path in package: %s' % path)
+    return os.path.join(directory, *parts)
+
+def _map_ordered(function, values, workers, processes, window):
+    """Applies the function to each value in a worker pool and yields the
+    results in order, with a limited number of values in flight.
+
+    """
+    if futures is None:
+        raise ImportError('concurrent.futures is required for parallel reads')
+
+    workers = workers or multiprocessing.cpu_count()
+    window = window or workers * 2
+
+    if processes:
+        executor = futures.ProcessPoolExecutor(workers)
+    else:
+        executor = futures.ThreadPoolExecutor(workers)
+
+    pending = collections.deque()
+    try:
+        for value in values:
+            pending.append(executor.submit(function, value))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown()
+
+def _open_compressed(file, key):
+    encoded_key = file.encode_key(key)
+    try:
+        chunks = file.get_binary_chunks(encoded_key)
+    except KeyError:
+        raise file._key_error(key, encoded_key)
+    return io.BufferedReader(DecompressingReader(chunks))
+
+def _read_tiles(data):
+    stream = io.BytesIO(data)
+    unknown = stream.read(3)
+    # There are 1024 (32x32) tiles in a region.
+    return [sbon.read_tile(stream) for _ in range(World.TILES_PER_REGION)]
+
+def _write_file(item):
+    path, data = item
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as e:
+        # Another worker may have created the directory already.
+        if e.errno != errno.EEXIST:
+            raise
+    with builtins.open(path, 'wb') as f:
+        f.write(data)
+    return len(data)
+
+
 EXTENSION_TO_CLASS = dict(
     chunks=CelestialChunks,
     clientcontext=sbvj01.FileSBVJ01,
@@ -203,18 +578,25 @@ EXTENSION_TO_CLASS = dict(
 )
 
 
-def open(path, override_extension=None):
+def open(path, override_extension=None, use_mmap=False, thread_safe=False):
     """Read the file located at the specified path. The file format will be
     guessed from the extension, or (if provided) using the extension override.
 
+    If use_mmap is True, block based files will be memory mapped. If
+    thread_safe is True, block based files can be read from several threads
+    at once.
+
     """
     extension = override_extension or os.path.splitext(path)[1][1:]
-    return read_stream(builtins.open(path, 'rb'), extension)
+    return read_stream(builtins.open(path, 'rb'), extension, use_mmap, thread_safe)
 
-def read_stream(stream, extension):
+def read_stream(stream, extension, use_mmap=False, thread_safe=False):
     cls = EXTENSION_TO_CLASS.get(extension)
     if not cls:
         raise ValueError('Unsupported file extension "%s"' % extension)
     file = cls(stream)
+    if isinstance(file, btreedb4.FileBTreeDB4):
+        file.use_mmap = use_mmap
+        file.thread_safe = thread_safe
     file.initialize()
     return file
@@ -110,7 +110,7 @@ def repair_world(world, blank_world=None):
                     if len(temp_stream.getvalue()) != 3 + 32 * 32 * 23:
                         continue
                 elif layer == 2:
-                    sbon.read_document_list(temp_stream)
+                    sbon.skip_document_list(temp_stream)
             except Exception:
                 continue
 
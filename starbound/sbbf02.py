@@ -1,5 +1,10 @@
+import collections
 import io
+import mmap
+import os
 import struct
+import sys
+import threading
 
 from . import filebase
 
@@ -45,6 +50,27 @@ class Block(BlockMeta('Block', (object,), {})):
         block.index = block_index
         return block
 
+    def get_size(self):
+        """Returns roughly how many bytes of memory the parsed block uses.
+
+        """
+        size = sys.getsizeof(self)
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if name == 'index':
+                    continue
+                value = getattr(self, name, None)
+                size += sys.getsizeof(value)
+                if isinstance(value, memoryview):
+                    # A view keeps the data it was sliced from alive, unless
+                    # that's the file's memory map.
+                    base = getattr(value, 'obj', None)
+                    if base is None:
+                        size += len(value)
+                    elif not isinstance(base, mmap.mmap):
+                        size += sys.getsizeof(base)
+        return size
+
 
 class BlockFree(Block):
     SIGNATURE = b'FF'
@@ -60,10 +86,142 @@ class BlockFree(Block):
         return 'Free(next_free_block={})'.format(self.next_free_block)
 
 
+class BlockCache(object):
+    """A least recently used cache of parsed blocks. The budget can be given
+    as a number of blocks, a number of bytes, or both.
+
+    If types is given (a block class or a tuple of them), only blocks of those
+    types are kept. For example, caching only btreedb4.BTreeIndex blocks keeps
+    the root and index blocks from being evicted by large values and scans.
+
+    """
+    def __init__(self, max_blocks=None, max_bytes=None, types=None):
+        assert max_blocks or max_bytes, 'A cache budget is required'
+        self.max_blocks = max_blocks
+        self.max_bytes = max_bytes
+        self.types = types
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+
+        # Maps block index to a (block, size) tuple.
+        self._blocks = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, block_index):
+        return block_index in self._blocks
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __str__(self):
+        return 'BlockCache(blocks={}, size={}, hits={}, misses={}, evictions={})'.format(
+            len(self._blocks), self.size, self.hits, self.misses, self.evictions)
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.size = 0
+
+    def get(self, block_index):
+        """Returns a (found, block) tuple. Blocks can be None, so a separate
+        flag is needed to tell a miss apart.
+
+        """
+        with self._lock:
+            try:
+                entry = self._blocks.pop(block_index)
+            except KeyError:
+                self.misses += 1
+                return False, None
+            # Reinsert the block to mark it as the most recently used.
+            self._blocks[block_index] = entry
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, block_index, block, size=None):
+        """Stores the block, unless the cache only keeps other types of blocks.
+        The size defaults to the memory used by the parsed block.
+
+        """
+        if self.types is not None and not isinstance(block, self.types):
+            return
+        if size is None:
+            size = block.get_size() if block is not None else 0
+
+        with self._lock:
+            blocks = self._blocks
+            if block_index in blocks:
+                self.size -= blocks.pop(block_index)[1]
+            blocks[block_index] = (block, size)
+            self.size += size
+
+            # Evict the least recently used blocks until within budget, but
+            # always keep the block that was just added.
+            while len(blocks) > 1 and (
+                    (self.max_blocks and len(blocks) > self.max_blocks) or
+                    (self.max_bytes and self.size > self.max_bytes)):
+                _, (_, evicted_size) = blocks.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+
+class BlockReader(object):
+    """A cursor over a block that has been mapped into memory. It stands in
+    for the file when parsing a block, so it forwards any other attribute
+    lookups (such as the block size) to the file.
+
+    """
+    __slots__ = ['_file', '_offset', '_view']
+
+    def __init__(self, file, view, offset):
+        self._file = file
+        self._offset = offset
+        self._view = view
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def read(self, length):
+        return self.read_view(length).tobytes()
+
+    def read_view(self, length):
+        offset = self._offset
+        self._offset += length
+        return self._view[offset:offset + length]
+
+
 class FileSBBF02(filebase.File):
     def __init__(self, stream):
         super(FileSBBF02, self).__init__(stream)
 
+        # Set this attribute to True before initializing to map the file into
+        # memory instead of seeking and reading for every block. This only
+        # works for streams backed by a real file.
+        self.use_mmap = False
+
+        # Set this attribute to a BlockCache to keep parsed blocks in memory.
+        self.block_cache = None
+
+        # Set this attribute to True before initializing to allow blocks to be
+        # read from several threads at once. Blocks are then read with
+        # os.pread (or from the memory map) so there's no shared file
+        # position, falling back to a lock around seeking and reading.
+        self.thread_safe = False
+
+        # The number of block reads that were shared with another thread that
+        # was already reading the same block (in thread-safe mode).
+        self.coalesced_reads = 0
+
+        self._fd = None
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._map = None
+        self._view = None
+
         self._user_header = None
 
         self.block_size = None
@@ -72,9 +230,33 @@ class FileSBBF02(filebase.File):
         self.free_block = None
         self.num_blocks = None
 
+    def close(self):
+        if self._map:
+            self._view.release()
+            self._view = None
+            try:
+                self._map.close()
+            except BufferError:
+                # Blocks that are still alive reference the mapped memory, so
+                # leave it to be unmapped once they're garbage collected.
+                pass
+            self._map = None
+        super(FileSBBF02, self).close()
+
     def get_block(self, block_index):
-        self._stream.seek(self.header_size + self.block_size * block_index)
-        return Block.read(self, block_index)
+        if self.thread_safe:
+            return self._read_block_shared(block_index)
+
+        cache = self.block_cache
+        if cache is not None:
+            found, block = cache.get(block_index)
+            if found:
+                return block
+
+        block = self.read_block(block_index)
+        if cache is not None:
+            cache.put(block_index, block)
+        return block
 
     def get_user_header(self):
         return io.BytesIO(self._user_header)
@@ -102,3 +284,132 @@ class FileSBBF02(filebase.File):
         # Read the user header data.
         stream.seek(32)
         self._user_header = stream.read(self.header_size - 32)
+
+        if self.use_mmap and not self._map:
+            self._open_map()
+
+        if self.thread_safe and hasattr(os, 'pread'):
+            try:
+                self._fd = stream.fileno()
+            except (AttributeError, io.UnsupportedOperation):
+                # Not a real file, so the lock will have to do.
+                self._fd = None
+
+    def read_block(self, block_index):
+        """Reads and parses a block, bypassing the block cache.
+
+        """
+        offset = self.header_size + self.block_size * block_index
+        if self._view is not None:
+            return Block.read(BlockReader(self, self._view, offset), block_index)
+        if self.thread_safe:
+            data = memoryview(self._read_at(offset, self.block_size))
+            return Block.read(BlockReader(self, data, 0), block_index)
+        self._stream.seek(offset)
+        return Block.read(self, block_index)
+
+    def read_block_data(self, block_index, offset, length):
+        """Returns length bytes starting at offset in the block, without
+        parsing the block or going through the block cache.
+
+        """
+        offset += self.header_size + self.block_size * block_index
+        if self._view is not None:
+            return self._view[offset:offset + length].tobytes()
+        if self.thread_safe:
+            return self._read_at(offset, length)
+        self._stream.seek(offset)
+        return self._stream.read(length)
+
+    def read_view(self, length):
+        """Like read, but may return a memoryview to avoid copying data.
+
+        """
+        return self.read(length)
+
+    def _open_map(self):
+        try:
+            fileno = self._stream.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            # Not a real file, so keep seeking and reading.
+            return
+
+        self._map = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        try:
+            self._view = memoryview(self._map)
+        except TypeError:
+            # Python 2 can't make a memoryview of a memory map.
+            self._map.close()
+            self._map = None
+
+    def _read_block_shared(self, block_index):
+        """Returns a cached block, or reads it, or waits for another thread
+        that is already reading it and shares its result.
+
+        """
+        cache = self.block_cache
+        with self._in_flight_lock:
+            # The cache is checked under the lock, since a thread that has just
+            # finished reading the block caches it before it stops being in
+            # flight. Checking it first could start a second read in between.
+            if cache is not None:
+                found, block = cache.get(block_index)
+                if found:
+                    return block
+            other = self._in_flight.get(block_index)
+            if other is not None:
+                self.coalesced_reads += 1
+            else:
+                pending = self._in_flight[block_index] = _PendingRead()
+        if other is not None:
+            return other.wait()
+
+        try:
+            block = self.read_block(block_index)
+            # Cache the block before releasing the waiters, so that no one
+            # starts another read in between.
+            if cache is not None:
+                cache.put(block_index, block)
+            pending.set_result(block)
+            return block
+        except BaseException as e:
+            # Waiters must always be released, even if the read was
+            # interrupted (for example by KeyboardInterrupt).
+            pending.set_error(e)
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[block_index]
+
+    def _read_at(self, offset, length):
+        if self._fd is not None:
+            return os.pread(self._fd, length, offset)
+        with self._lock:
+            self._stream.seek(offset)
+            return self._stream.read(length)
+
+
+class _PendingRead(object):
+    """A block read that other threads can wait on.
+
+    """
+    __slots__ = ['_done', 'block', 'error']
+
+    def __init__(self):
+        self._done = threading.Event()
+        self.block = None
+        self.error = None
+
+    def set_error(self, error):
+        self.error = error
+        self._done.set()
+
+    def set_result(self, block):
+        self.block = block
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.block
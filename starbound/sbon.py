@@ -1,6 +1,16 @@
 import collections
 import struct
 
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 # Override range with xrange when running Python 2.x.
 try:
@@ -8,6 +18,14 @@ try:
 except:
     pass
 
+# Include the separate unicode and long types when running Python 2.x.
+try:
+    _INTEGER_TYPES = (int, long)
+    _STRING_TYPES = (str, unicode)
+except NameError:
+    _INTEGER_TYPES = (int,)
+    _STRING_TYPES = (str,)
+
 
 Document = collections.namedtuple('Document', ['name', 'version', 'data'])
 
@@ -31,11 +49,416 @@ Tile = collections.namedtuple('Tile', [
     'indestructible',
 ])
 
+TILE_FORMAT = '>hBBhBhBBhBBHBhBB?'
+TILE_SIZE = struct.calcsize(TILE_FORMAT)
+_TILE = struct.Struct(TILE_FORMAT)
+
+# A NumPy structured type with the same fields as Tile (if NumPy is available).
+if numpy:
+    _NUMPY_TYPES = {'h': '>i2', 'H': '>u2', 'B': 'u1', '?': '?'}
+    TILE_DTYPE = numpy.dtype([(field, _NUMPY_TYPES[code])
+                              for field, code in zip(Tile._fields, TILE_FORMAT[1:])])
+else:
+    TILE_DTYPE = None
+
+_DOUBLE = struct.Struct('>d')
+_INT = struct.Struct('>i')
+
+# Encoded varlen numbers that fit in a single byte.
+_SMALL_NUMBERS = [struct.pack('B', value) for value in range(0b10000000)]
+
+
+class StringTable(object):
+    """A bounded table of decoded strings, keyed by their UTF-8 data. Strings
+    that repeat (like map keys) are only decoded once and share a single
+    object. Strings longer than max_length (in bytes) are never added.
+
+    Recently used strings are kept in one dict and the rest in another. When
+    the first one holds max_size strings, the second one is thrown away and
+    they swap places, so strings that stop being used are eventually evicted.
+
+    """
+    __slots__ = ['max_length', 'max_size', '_old_strings', '_strings']
+
+    def __init__(self, max_size=4096, max_length=None):
+        self.max_length = max_length
+        self.max_size = max_size
+        self._old_strings = dict()
+        self._strings = dict()
+
+    def __len__(self):
+        return len(set(self._strings).union(self._old_strings))
+
+    def clear(self):
+        self._old_strings.clear()
+        self._strings.clear()
+
+    def decode(self, data):
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        string = self._strings.get(data)
+        if string is not None:
+            return string
+
+        string = self._old_strings.get(data)
+        if string is None:
+            string = data.decode('utf-8')
+            if self.max_length is not None and len(data) > self.max_length:
+                return string
+
+        if len(self._strings) >= self.max_size:
+            self._old_strings = self._strings
+            self._strings = dict()
+        self._strings[data] = string
+        return string
+
+
+# The table used for map keys. Set to None to decode every key separately.
+# Long keys are usually unique identifiers, so they aren't kept.
+KEY_TABLE = StringTable(max_length=64)
+
+# The table used for string values. Set this to a StringTable with a small
+# max_length to share repeated short values (such as material names).
+VALUE_TABLE = None
+
+
+class LazyList(Sequence):
+    """A read-only list that decodes each item from the buffer when it's first
+    accessed. Created by the decode_*/read_* functions when lazy is True.
+
+    """
+    __slots__ = ['_buffer', '_offsets', '_values']
+
+    def __init__(self, buffer, offsets):
+        self._buffer = buffer
+        self._offsets = offsets
+        self._values = dict()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return LazyList(self._buffer, self._offsets[index])
+        if index < 0:
+            index += len(self._offsets)
+            if index < 0:
+                raise IndexError('list index out of range')
+        try:
+            return self._values[index]
+        except KeyError:
+            pass
+        offset = self._offsets[index]
+        value, _ = _decode_lazy(self._buffer, offset + 1, self._buffer[offset])
+        self._values[index] = value
+        return value
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __repr__(self):
+        return 'LazyList(length={})'.format(len(self._offsets))
+
+
+class LazyMap(Mapping):
+    """A read-only map that decodes each value from the buffer when it's first
+    accessed. Only the keys are decoded up front. Created by the
+    decode_*/read_* functions when lazy is True.
+
+    """
+    __slots__ = ['_buffer', '_offsets', '_values']
+
+    def __init__(self, buffer, offsets):
+        self._buffer = buffer
+        self._offsets = offsets
+        self._values = dict()
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        offset = self._offsets[key]
+        value, _ = _decode_lazy(self._buffer, offset + 1, self._buffer[offset])
+        self._values[key] = value
+        return value
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __repr__(self):
+        return 'LazyMap(keys={!r})'.format(list(self._offsets))
+
+
+def decode_bytes(buffer, offset=0):
+    """Like the read_* functions, the decode_* functions read SBON data, but
+    from a bytes-like buffer at the provided offset instead of a stream. They
+    return the value and the offset right after it.
+
+    """
+    buffer = _as_buffer(buffer)
+    length, offset = _decode_varlen_number(buffer, offset)
+    end = _check_end(buffer, offset + length)
+    return bytes(buffer[offset:end]), end
+
+def decode_document(buffer, offset=0, lazy=False):
+    buffer = _as_buffer(buffer)
+    name, offset = _decode_value(buffer, offset, 5)
+
+    # Not sure what this part is.
+    assert buffer[offset] == 1
+
+    version, = _INT.unpack_from(buffer, offset + 1)
+    offset += 5
+    decode = _decode_lazy if lazy else _decode_value
+    data, offset = decode(buffer, offset + 1, buffer[offset])
+
+    return Document(name, version, data), offset
+
+def decode_document_list(buffer, offset=0):
+    buffer = _as_buffer(buffer)
+    length, offset = _decode_varlen_number(buffer, offset)
+    value = []
+    for _ in range(length):
+        document, offset = decode_document(buffer, offset)
+        value.append(document)
+    return value, offset
+
+def decode_dynamic(buffer, offset=0, lazy=False):
+    """Decodes a dynamic value. If lazy is True, maps and lists are returned as
+    LazyMap and LazyList objects that decode their contents on access.
+
+    """
+    buffer = _as_buffer(buffer)
+    decode = _decode_lazy if lazy else _decode_value
+    return decode(buffer, offset + 1, buffer[offset])
+
+def decode_list(buffer, offset=0):
+    return _decode_value(_as_buffer(buffer), offset, 6)
+
+def decode_map(buffer, offset=0):
+    return _decode_value(_as_buffer(buffer), offset, 7)
+
+def decode_string(buffer, offset=0):
+    return _decode_value(_as_buffer(buffer), offset, 5)
+
+def decode_string_digest_map(buffer, offset=0):
+    buffer = _as_buffer(buffer)
+    length, offset = _decode_varlen_number(buffer, offset)
+    value = dict()
+    for _ in range(length):
+        path, offset = _decode_value(buffer, offset, 5)
+        # Skip unnecessary whitespace.
+        value[path] = bytes(buffer[offset + 1:_check_end(buffer, offset + 33)])
+        offset += 33
+    return value, offset
+
+def decode_string_list(buffer, offset=0):
+    buffer = _as_buffer(buffer)
+    length, offset = _decode_varlen_number(buffer, offset)
+    value = []
+    for _ in range(length):
+        item, offset = _decode_value(buffer, offset, 5)
+        value.append(item)
+    return value, offset
+
+def decode_varlen_number(buffer, offset=0):
+    return _decode_varlen_number(_as_buffer(buffer), offset)
+
+def decode_varlen_numbers(buffer, count, offset=0):
+    """Decodes count consecutive varlen numbers and returns them as a list,
+    along with the offset after the last one.
+
+    """
+    buffer = _as_buffer(buffer)
+    values = []
+    append = values.append
+    for _ in range(count):
+        value = buffer[offset]
+        offset += 1
+        if value >= 0b10000000:
+            value &= 0b01111111
+            while True:
+                byte = buffer[offset]
+                offset += 1
+                value = value << 7 | (byte & 0b01111111)
+                if not byte & 0b10000000:
+                    break
+        append(value)
+    return values, offset
+
+def decode_varlen_number_signed(buffer, offset=0):
+    value, offset = _decode_varlen_number(_as_buffer(buffer), offset)
+
+    # Least significant bit represents the sign.
+    if value & 1:
+        return -(value >> 1), offset
+    else:
+        return value >> 1, offset
+
+def encode_bytes(value, buffer=None):
+    """Like the write_* functions, the encode_* functions write SBON data, but
+    append it to a bytearray (a new one unless provided), which is returned.
+
+    """
+    if buffer is None:
+        buffer = bytearray()
+    _encode_varlen_number(buffer, len(value))
+    buffer += value
+    return buffer
+
+def encode_document(document, buffer=None):
+    """Encodes a Document (or a name, version, data tuple).
+
+    """
+    if buffer is None:
+        buffer = bytearray()
+    name, version, data = document
+    _encode_string(buffer, name)
+    # Not sure what this part is.
+    buffer.append(1)
+    buffer += _INT.pack(version)
+    _encode_value(buffer, data)
+    return buffer
+
+def encode_document_list(documents, buffer=None):
+    if buffer is None:
+        buffer = bytearray()
+    _encode_varlen_number(buffer, len(documents))
+    for document in documents:
+        encode_document(document, buffer)
+    return buffer
+
+def encode_dynamic(value, buffer=None):
+    if buffer is None:
+        buffer = bytearray()
+    _encode_value(buffer, value)
+    return buffer
+
+def encode_list(value, buffer=None):
+    if buffer is None:
+        buffer = bytearray()
+    _encode_varlen_number(buffer, len(value))
+    for item in value:
+        _encode_value(buffer, item)
+    return buffer
+
+def encode_map(value, buffer=None):
+    if buffer is None:
+        buffer = bytearray()
+    _encode_varlen_number(buffer, len(value))
+    for key, item in value.items():
+        _encode_string(buffer, key)
+        _encode_value(buffer, item)
+    return buffer
+
+def encode_string(value, buffer=None):
+    if buffer is None:
+        buffer = bytearray()
+    _encode_string(buffer, value)
+    return buffer
+
+def encode_tile(tile, buffer=None):
+    if buffer is None:
+        buffer = bytearray()
+    buffer += _TILE.pack(*tile)
+    return buffer
+
+def encode_varlen_number(value, buffer=None):
+    if buffer is None:
+        buffer = bytearray()
+    _encode_varlen_number(buffer, value)
+    return buffer
+
+def encode_varlen_number_signed(value, buffer=None):
+    if buffer is None:
+        buffer = bytearray()
+    _encode_varlen_number_signed(buffer, value)
+    return buffer
+
+def extract(stream, path):
+    """Reads the part of the dynamic value in the stream that is found by
+    following the path, a list of map keys and list indexes. Everything else
+    is skipped over without being built. Raises KeyError if the path doesn't
+    exist. The stream is left right after the extracted value.
+
+    """
+    for part in path:
+        type = ord(stream.read(1))
+        if type not in (6, 7):
+            raise KeyError(part)
+
+        length = read_varlen_number(stream)
+        if type == 7:
+            for _ in range(length):
+                if _read_key(stream) == part:
+                    break
+                skip_dynamic(stream)
+            else:
+                raise KeyError(part)
+        else:
+            if not isinstance(part, int) or not 0 <= part < length:
+                raise KeyError(part)
+            for _ in range(part):
+                skip_dynamic(stream)
+
+    return read_dynamic(stream)
+
+def iter_events(stream):
+    """Yields (event, value) tuples while reading a dynamic value from the
+    stream, without building any maps or lists. The events are start_map,
+    map_key, end_map, start_list, end_list and value. Only map_key (the key)
+    and value (a number, string, boolean or None) events have values.
+
+    """
+    # The number of items left to read and whether it's a map, for each of
+    # the currently open maps and lists.
+    containers = []
+    while True:
+        if containers:
+            container = containers[-1]
+            if not container[0]:
+                containers.pop()
+                yield 'end_map' if container[1] else 'end_list', None
+                if not containers:
+                    return
+                continue
+            container[0] -= 1
+            if container[1]:
+                yield 'map_key', _read_key(stream)
+
+        type = ord(stream.read(1))
+        if type == 6 or type == 7:
+            length = read_varlen_number(stream)
+            yield 'start_map' if type == 7 else 'start_list', None
+            containers.append([length, type == 7])
+            continue
+
+        yield 'value', _read_value(stream, type)
+        if not containers:
+            return
+
+def materialize(value):
+    """Returns a copy of the value where any LazyMap and LazyList objects have
+    been fully decoded into dicts and lists.
+
+    """
+    if isinstance(value, LazyMap):
+        return dict((key, materialize(item)) for key, item in value.items())
+    if isinstance(value, LazyList):
+        return [materialize(item) for item in value]
+    return value
+
 def read_bytes(stream):
     length = read_varlen_number(stream)
     return stream.read(length)
 
-def read_document(stream, repair=False):
+def read_document(stream, repair=False, lazy=False):
+    if lazy:
+        return _decode_lazy_from_stream(decode_document, stream)
+    if not repair and hasattr(stream, 'getbuffer'):
+        return _decode_from_stream(decode_document, stream)
+
     name = read_string(stream)
 
     # Not sure what this part is.
@@ -47,10 +470,18 @@ def read_document(stream, repair=False):
     return Document(name, version, data)
 
 def read_document_list(stream):
+    if hasattr(stream, 'getbuffer'):
+        return _decode_from_stream(decode_document_list, stream)
+
     length = read_varlen_number(stream)
     return [read_document(stream) for _ in range(length)]
 
-def read_dynamic(stream, repair=False):
+def read_dynamic(stream, repair=False, lazy=False):
+    if lazy:
+        return _decode_lazy_from_stream(decode_dynamic, stream)
+    if not repair and hasattr(stream, 'getbuffer'):
+        return _decode_from_stream(decode_dynamic, stream)
+
     type = ord(stream.read(1))
 
     try:
@@ -90,18 +521,23 @@ def read_map(stream, repair=False):
 
     value = dict()
     for _ in range(length):
-        key = read_string(stream)
+        key = _read_key(stream)
         value[key] = read_dynamic(stream, repair)
 
     return value
 
 def read_string(stream):
+    if VALUE_TABLE is not None:
+        return VALUE_TABLE.decode(read_bytes(stream))
     return read_bytes(stream).decode('utf-8')
 
 def read_string_list(stream):
     """Optimized structure that doesn't have a type byte for every item.
 
     """
+    if hasattr(stream, 'getbuffer'):
+        return _decode_from_stream(decode_string_list, stream)
+
     length = read_varlen_number(stream)
     return [read_string(stream) for _ in range(length)]
 
@@ -109,6 +545,9 @@ def read_string_digest_map(stream):
     """Special structure of string/digest pairs, used by the assets database.
 
     """
+    if hasattr(stream, 'getbuffer'):
+        return _decode_from_stream(decode_string_digest_map, stream)
+
     length = read_varlen_number(stream)
 
     value = dict()
@@ -122,9 +561,19 @@ def read_string_digest_map(stream):
     return value
 
 def read_tile(stream):
-    values = struct.unpack('>hBBhBhBBhBBHBhBB?', stream.read(23))
+    values = struct.unpack(TILE_FORMAT, stream.read(TILE_SIZE))
     return Tile(*values)
 
+def read_tiles_array(data, count, offset=0):
+    """Returns a NumPy array (with the TILE_DTYPE type) of the tiles in the
+    buffer, starting at offset. The array is a view over the buffer, so no
+    data is copied.
+
+    """
+    if numpy is None:
+        raise ImportError('NumPy is required to read tiles into an array')
+    return numpy.frombuffer(data, dtype=TILE_DTYPE, count=count, offset=offset)
+
 def read_varlen_number(stream):
     """Read while the most significant bit is set, then put the 7 least
     significant bits of all read bytes together to create a number.
@@ -146,26 +595,379 @@ def read_varlen_number_signed(stream):
     else:
         return value >> 1
 
+def skip_bytes(stream):
+    """Moves the stream past a bytes (or string) value without reading it.
+
+    """
+    length = read_varlen_number(stream)
+    stream.seek(length, 1)
+
+def skip_document(stream):
+    if hasattr(stream, 'getbuffer'):
+        return _skip_in_stream(_skip_document, stream)
+
+    skip_bytes(stream)
+    assert stream.read(1) == b'\x01'
+    stream.seek(4, 1)
+    skip_dynamic(stream)
+
+def skip_document_list(stream):
+    if hasattr(stream, 'getbuffer'):
+        return _skip_in_stream(_skip_document_list, stream)
+
+    for _ in range(read_varlen_number(stream)):
+        skip_document(stream)
+
+def skip_dynamic(stream):
+    """Moves the stream past a dynamic value by only reading type bytes and
+    lengths, without building any values.
+
+    """
+    if hasattr(stream, 'getbuffer'):
+        return _skip_in_stream(_skip_dynamic, stream)
+
+    type = ord(stream.read(1))
+    if type == 1:
+        pass
+    elif type == 2:
+        stream.seek(8, 1)
+    elif type == 3:
+        stream.seek(1, 1)
+    elif type == 4:
+        read_varlen_number(stream)
+    elif type == 5:
+        skip_bytes(stream)
+    elif type == 6:
+        for _ in range(read_varlen_number(stream)):
+            skip_dynamic(stream)
+    elif type == 7:
+        for _ in range(read_varlen_number(stream)):
+            skip_bytes(stream)
+            skip_dynamic(stream)
+    else:
+        raise ValueError('Unknown dynamic type 0x%02X' % type)
+
 def write_bytes(stream, bytes):
     write_varlen_number(stream, len(bytes))
     stream.write(bytes)
 
+def write_document(stream, document):
+    stream.write(encode_document(document))
+
+def write_document_list(stream, documents):
+    stream.write(encode_document_list(documents))
+
+def write_dynamic(stream, value):
+    stream.write(encode_dynamic(value))
+
+def write_list(stream, value):
+    stream.write(encode_list(value))
+
+def write_map(stream, value):
+    stream.write(encode_map(value))
+
+def write_string(stream, value):
+    stream.write(encode_string(value))
+
+def write_tile(stream, tile):
+    stream.write(_TILE.pack(*tile))
+
 def write_varlen_number(stream, value):
-    if value == 0:
-        stream.write(b'\x00')
+    if 0 <= value < 0b10000000:
+        stream.write(_SMALL_NUMBERS[value])
         return
+    buffer = bytearray()
+    _encode_varlen_number(buffer, value)
+    stream.write(buffer)
 
-    pieces = []
+def write_varlen_number_signed(stream, value):
+    # Least significant bit represents the sign.
+    has_sign = 1 if value < 0 else 0
+    write_varlen_number(stream, abs(value) << 1 | has_sign)
+
+def _as_buffer(buffer):
+    """Returns a buffer that gives integers when indexed and that can be sliced
+    into objects with a decode method.
+
+    """
+    if bytes is str:
+        # Indexing strings gives characters in Python 2.x.
+        return buffer if isinstance(buffer, bytearray) else bytearray(buffer)
+    if isinstance(buffer, memoryview):
+        return buffer.tobytes()
+    return buffer
+
+def _check_end(buffer, end):
+    if end > len(buffer):
+        raise ValueError('Unexpected end of data')
+    return end
+
+def _decode_from_stream(decode, stream):
+    """Decodes a value directly from the buffer of an in-memory stream (such as
+    io.BytesIO) instead of reading it piece by piece, then moves the stream
+    past the value.
+
+    """
+    value, offset = decode(stream.getvalue(), stream.tell())
+    stream.seek(offset)
+    return value
+
+def _decode_key(buffer, offset):
+    length = buffer[offset]
+    if length < 0b10000000:
+        offset += 1
+    else:
+        length, offset = _decode_varlen_number(buffer, offset)
+    end = _check_end(buffer, offset + length)
+    if KEY_TABLE is None:
+        return buffer[offset:end].decode('utf-8'), end
+    # Look up the table directly since this is called for every map key.
+    data = buffer[offset:end]
+    try:
+        key = KEY_TABLE._strings.get(data)
+    except TypeError:
+        # Slices of a bytearray can't be used as keys.
+        key = None
+    if key is None:
+        key = KEY_TABLE.decode(data)
+    return key, end
+
+def _decode_lazy(buffer, offset, type):
+    """Like _decode_value, but maps and lists only record the offsets of their
+    values, which are skipped over instead of decoded.
+
+    """
+    if type == 7:
+        length, offset = _decode_varlen_number(buffer, offset)
+        offsets = dict()
+        for _ in range(length):
+            key, offset = _decode_key(buffer, offset)
+            offsets[key] = offset
+            offset = _skip_dynamic(buffer, offset)
+        return LazyMap(buffer, offsets), offset
+    elif type == 6:
+        length, offset = _decode_varlen_number(buffer, offset)
+        offsets = []
+        for _ in range(length):
+            offsets.append(offset)
+            offset = _skip_dynamic(buffer, offset)
+        return LazyList(buffer, offsets), offset
+    return _decode_value(buffer, offset, type)
+
+def _decode_lazy_from_stream(decode, stream):
+    """Decodes a value lazily from the rest of the stream. The lazy objects
+    keep a reference to the data, so it's read once and then the stream is
+    moved back to right after the value.
+
+    """
+    if hasattr(stream, 'getbuffer'):
+        value, offset = decode(stream.getvalue(), stream.tell(), lazy=True)
+        stream.seek(offset)
+        return value
+    data = stream.read()
+    value, offset = decode(data, 0, lazy=True)
+    stream.seek(offset - len(data), 1)
+    return value
+
+def _decode_value(buffer, offset, type):
+    """Decodes a dynamic value of the provided type, starting right after the
+    type byte. This is the hot path of decoding, so the most common types are
+    checked first and short varlen numbers are read inline.
+
+    """
+    if type == 5:
+        length = buffer[offset]
+        if length < 0b10000000:
+            offset += 1
+        else:
+            length, offset = _decode_varlen_number(buffer, offset)
+        end = _check_end(buffer, offset + length)
+        if VALUE_TABLE is not None:
+            return VALUE_TABLE.decode(buffer[offset:end]), end
+        return buffer[offset:end].decode('utf-8'), end
+    elif type == 4:
+        value = buffer[offset]
+        if value < 0b10000000:
+            offset += 1
+        else:
+            value, offset = _decode_varlen_number(buffer, offset)
+        # Least significant bit represents the sign.
+        return (-(value >> 1) if value & 1 else value >> 1), offset
+    elif type == 7:
+        length, offset = _decode_varlen_number(buffer, offset)
+        value = dict()
+        for _ in range(length):
+            key, offset = _decode_key(buffer, offset)
+            value[key], offset = _decode_value(buffer, offset + 1, buffer[offset])
+        return value, offset
+    elif type == 6:
+        length, offset = _decode_varlen_number(buffer, offset)
+        value = []
+        for _ in range(length):
+            item, offset = _decode_value(buffer, offset + 1, buffer[offset])
+            value.append(item)
+        return value, offset
+    elif type == 2:
+        return _DOUBLE.unpack_from(buffer, offset)[0], offset + 8
+    elif type == 3:
+        return buffer[offset] != 0, offset + 1
+    elif type == 1:
+        return None, offset
+    else:
+        raise ValueError('Unknown dynamic type 0x%02X' % type)
+
+def _decode_varlen_number(buffer, offset):
+    value = buffer[offset]
+    if value < 0b10000000:
+        return value, offset + 1
+
+    value = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        if not byte & 0b10000000:
+            return value << 7 | byte, offset
+        value = value << 7 | (byte & 0b01111111)
+
+def _encode_string(buffer, value):
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    _encode_varlen_number(buffer, len(value))
+    buffer += value
+
+def _encode_value(buffer, value):
+    """Appends the type byte and data of a dynamic value to the buffer.
+
+    """
+    if isinstance(value, _STRING_TYPES):
+        buffer.append(5)
+        _encode_string(buffer, value)
+    elif isinstance(value, bool):
+        # This has to come before integers since booleans are integers.
+        buffer.append(3)
+        buffer.append(1 if value else 0)
+    elif isinstance(value, _INTEGER_TYPES):
+        buffer.append(4)
+        _encode_varlen_number_signed(buffer, value)
+    elif isinstance(value, (dict, Mapping)):
+        buffer.append(7)
+        _encode_varlen_number(buffer, len(value))
+        for key, item in value.items():
+            _encode_string(buffer, key)
+            _encode_value(buffer, item)
+    elif isinstance(value, (list, tuple)) or (
+            isinstance(value, Sequence) and not isinstance(value, (bytes, bytearray))):
+        # Any other sequence (such as a LazyList) is encoded as a list too.
+        buffer.append(6)
+        _encode_varlen_number(buffer, len(value))
+        for item in value:
+            _encode_value(buffer, item)
+    elif isinstance(value, float):
+        buffer.append(2)
+        buffer += _DOUBLE.pack(value)
+    elif value is None:
+        buffer.append(1)
+    else:
+        raise TypeError('Cannot encode %s as a dynamic value' % type(value).__name__)
+
+def _encode_varlen_number(buffer, value):
+    if value < 0b10000000:
+        if value < 0:
+            raise ValueError('Number must not be negative')
+        buffer.append(value)
+        return
+
+    # Write the 7 bit groups from least to most significant, then reverse them.
+    start = len(buffer)
+    buffer.append(value & 0b01111111)
+    value >>= 7
     while value:
-        x, value = value & 0b01111111, value >> 7
-        if len(pieces):
-            x |= 0b10000000
-        pieces.insert(0, x)
-        if len(pieces) > 4096:
-            raise ValueError('Number too large')
+        buffer.append(value & 0b01111111 | 0b10000000)
+        value >>= 7
+    buffer[start:] = buffer[start:][::-1]
 
-    stream.write(struct.pack('%dB' % len(pieces), *pieces))
+def _encode_varlen_number_signed(buffer, value):
+    # Least significant bit represents the sign.
+    if value < 0:
+        _encode_varlen_number(buffer, -value << 1 | 1)
+    else:
+        _encode_varlen_number(buffer, value << 1)
 
-def write_varlen_number_signed(stream, value):
-    has_sign = 1 if value < 0 else 0
-    write_varlen_number(stream, value << 1 | has_sign)
+def _read_key(stream):
+    if KEY_TABLE is not None:
+        return KEY_TABLE.decode(read_bytes(stream))
+    return read_bytes(stream).decode('utf-8')
+
+def _read_value(stream, type):
+    """Reads a dynamic value that isn't a map or a list, of the provided type.
+
+    """
+    if type == 1:
+        return None
+    elif type == 2:
+        return struct.unpack('>d', stream.read(8))[0]
+    elif type == 3:
+        return struct.unpack('?', stream.read(1))[0]
+    elif type == 4:
+        return read_varlen_number_signed(stream)
+    elif type == 5:
+        return read_string(stream)
+    else:
+        raise ValueError('Unknown dynamic type 0x%02X' % type)
+
+def _skip_bytes(buffer, offset):
+    length = buffer[offset]
+    if length < 0b10000000:
+        offset += 1
+    else:
+        length, offset = _decode_varlen_number(buffer, offset)
+    return _check_end(buffer, offset + length)
+
+def _skip_document(buffer, offset):
+    offset = _skip_bytes(buffer, offset)
+    assert buffer[offset] == 1
+    return _skip_dynamic(buffer, offset + 5)
+
+def _skip_document_list(buffer, offset):
+    length, offset = _decode_varlen_number(buffer, offset)
+    for _ in range(length):
+        offset = _skip_document(buffer, offset)
+    return offset
+
+def _skip_dynamic(buffer, offset):
+    """Returns the offset after the dynamic value at the provided offset.
+
+    """
+    type = buffer[offset]
+    offset += 1
+
+    if type == 5:
+        return _skip_bytes(buffer, offset)
+    elif type == 4:
+        while buffer[offset] & 0b10000000:
+            offset += 1
+        return offset + 1
+    elif type == 7:
+        length, offset = _decode_varlen_number(buffer, offset)
+        for _ in range(length):
+            offset = _skip_dynamic(buffer, _skip_bytes(buffer, offset))
+        return offset
+    elif type == 6:
+        length, offset = _decode_varlen_number(buffer, offset)
+        for _ in range(length):
+            offset = _skip_dynamic(buffer, offset)
+        return offset
+    elif type == 2:
+        return _check_end(buffer, offset + 8)
+    elif type == 3:
+        return _check_end(buffer, offset + 1)
+    elif type == 1:
+        return offset
+    else:
+        raise ValueError('Unknown dynamic type 0x%02X' % type)
+
+def _skip_in_stream(skip, stream):
+    """Moves an in-memory stream past a value using its buffer.
+
+    """
+    stream.seek(skip(_as_buffer(stream.getvalue()), stream.tell()))
@@ -7,6 +7,10 @@ class FileSBVJ01(filebase.File):
         super(FileSBVJ01, self).__init__(path)
         self.data = None
 
+        # Set this attribute to True before initializing to decode the data on
+        # access (see sbon.LazyMap).
+        self.lazy = False
+
     def initialize(self):
         """Reads the file contents into a data dict.
 
@@ -14,7 +18,8 @@ class FileSBVJ01(filebase.File):
         super(FileSBVJ01, self).initialize()
 
         assert self.read(6) == b'SBVJ01', 'Invalid file format'
-        self.identifier, self.version, self.data = sbon.read_document(self._stream)
+        self.identifier, self.version, self.data = sbon.read_document(
+            self._stream, lazy=self.lazy)
 
         # Technically, we could already close the file at this point. Need to
         # think about this.
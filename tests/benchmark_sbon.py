@@ -0,0 +1,138 @@
+"""Rough benchmarks of SBON reading and writing. Run this file directly:
+
+    python tests/benchmark_sbon.py
+
+"""
+import io
+import os
+import random
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from starbound import sbon
+
+
+def make_document(seed=1):
+    """Returns a document shaped roughly like world entity data: a few hundred
+    maps of mixed values.
+
+    """
+    rng = random.Random(seed)
+    items = []
+    for i in range(300):
+        items.append({
+            u'name': u'item%d' % rng.randint(0, 50),
+            u'count': rng.randint(1, 1000),
+            u'position': [rng.uniform(0, 4000), rng.uniform(0, 3000)],
+            u'flags': [rng.choice([True, False]) for _ in range(4)],
+            u'parameters': {u'color': rng.choice([u'red', u'green', u'blue']),
+                            u'seed': rng.randint(-2 ** 40, 2 ** 40), u'owner': None},
+        })
+    return sbon.Document(u'ObjectEntity', 8, {u'items': items})
+
+
+def report(name, seconds, number, size=None):
+    per_call = seconds / number
+    line = '%-40s %10.3f ms' % (name, per_call * 1e3)
+    if size:
+        line += ' %8.1f MB/s' % (size / per_call / 1e6)
+    print(line)
+
+
+def run(name, function, number, size=None):
+    report(name, min(timeit.repeat(function, number=number, repeat=3)), number, size)
+
+
+def benchmark_decoding(document, data):
+    print('Decoding a %d byte document' % len(data))
+    # A stream without getbuffer makes the read_* functions use the stream
+    # path, which reads the data a few bytes at a time.
+    run('read_document (stream path)',
+        lambda: sbon.read_document(io.BufferedReader(io.BytesIO(data))), 20, len(data))
+    run('read_document (BytesIO, buffer path)',
+        lambda: sbon.read_document(io.BytesIO(data)), 20, len(data))
+    run('decode_document', lambda: sbon.decode_document(data), 20, len(data))
+    run('decode_document (lazy)', lambda: sbon.decode_document(data, lazy=True), 20, len(data))
+
+    strings = [u'/items/generic/item%d.item' % i for i in range(5000)]
+    buffer = sbon.encode_varlen_number(len(strings))
+    for string in strings:
+        sbon.encode_string(string, buffer)
+    buffer = bytes(buffer)
+    print('Decoding a list of %d strings' % len(strings))
+    run('read_string_list (stream path)',
+        lambda: sbon.read_string_list(io.BufferedReader(io.BytesIO(buffer))), 20, len(buffer))
+    run('decode_string_list', lambda: sbon.decode_string_list(buffer), 20, len(buffer))
+
+
+def benchmark_encoding(document, data):
+    print('Encoding a %d byte document' % len(data))
+    run('encode_document', lambda: sbon.encode_document(document), 20, len(data))
+    run('write_document (BytesIO)', lambda: sbon.write_document(io.BytesIO(), document), 20, len(data))
+
+
+def benchmark_varlen_numbers():
+    rng = random.Random(2)
+    numbers = [rng.choice([rng.randint(0, 127), rng.randint(128, 2 ** 14), rng.randint(2 ** 14, 2 ** 35)])
+               for _ in range(10000)]
+    buffer = bytearray()
+    for number in numbers:
+        sbon.encode_varlen_number(number, buffer)
+    buffer = bytes(buffer)
+    count = len(numbers)
+
+    def read_each():
+        stream = io.BufferedReader(io.BytesIO(buffer))
+        for _ in range(count):
+            sbon.read_varlen_number(stream)
+
+    def decode_each():
+        offset = 0
+        for _ in range(count):
+            _, offset = sbon.decode_varlen_number(buffer, offset)
+
+    print('Per varlen number (%d numbers, mixed sizes)' % count)
+    run_each('old write_varlen_number', lambda: [_old_write_varlen_number(io.BytesIO(), n) for n in numbers], count)
+    run_each('write_varlen_number', lambda: [sbon.write_varlen_number(io.BytesIO(), n) for n in numbers], count)
+    run_each('encode_varlen_number', lambda: [sbon.encode_varlen_number(n) for n in numbers], count)
+    run_each('read_varlen_number (stream)', read_each, count)
+    run_each('decode_varlen_number', decode_each, count)
+    run_each('decode_varlen_numbers (bulk)', lambda: sbon.decode_varlen_numbers(buffer, count), count)
+
+
+def run_each(name, function, count):
+    seconds = min(timeit.repeat(function, number=5, repeat=3)) / 5
+    print('%-40s %10.1f ns' % (name, seconds / count * 1e9))
+
+
+def _old_write_varlen_number(stream, value):
+    # The implementation before the encoder was optimized, for comparison.
+    if value == 0:
+        stream.write(b'\x00')
+        return
+
+    pieces = []
+    while value:
+        x, value = value & 0b01111111, value >> 7
+        if len(pieces):
+            x |= 0b10000000
+        pieces.insert(0, x)
+        if len(pieces) > 4096:
+            raise ValueError('Number too large')
+
+    stream.write(struct.pack('%dB' % len(pieces), *pieces))
+
+
+def main():
+    document = make_document()
+    data = bytes(sbon.encode_document(document))
+    benchmark_decoding(document, data)
+    benchmark_encoding(document, data)
+    benchmark_varlen_numbers()
+
+
+if __name__ == '__main__':
+    main()
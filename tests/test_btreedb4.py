@@ -0,0 +1,228 @@
+import io
+import os
+import struct
+import tempfile
+import unittest
+
+from starbound import btreedb4, sbbf02, sbon
+
+
+BLOCK_SIZE = 64
+HEADER_SIZE = 512
+KEY_SIZE = 4
+# Bytes of value data in each leaf block ("LL" and the next block take 6).
+LEAF_DATA_SIZE = BLOCK_SIZE - 6
+
+
+def build_database(leaves):
+    """Returns the bytes of a BTreeDB4 file with small blocks. Each leaf is a
+    list of (key, value) pairs that are stored together, so that tests can
+    control where values fall relative to block boundaries.
+
+    """
+    blocks = []
+
+    # Write the leaves, splitting each across as many blocks as it needs.
+    children = []
+    for items in leaves:
+        stream = io.BytesIO()
+        stream.write(struct.pack('>i', len(items)))
+        for key, value in items:
+            stream.write(key)
+            sbon.write_bytes(stream, value)
+        data = stream.getvalue()
+
+        children.append((items[0][0], len(blocks)))
+        chunks = [data[i:i + LEAF_DATA_SIZE] for i in range(0, len(data), LEAF_DATA_SIZE)]
+        for i, chunk in enumerate(chunks):
+            next_block = len(blocks) + 1 if i < len(chunks) - 1 else -1
+            blocks.append(b'LL' + chunk.ljust(LEAF_DATA_SIZE, b'\x00') + struct.pack('>i', next_block))
+
+    # Add index levels until there's a single root.
+    max_keys = (BLOCK_SIZE - 11) // (KEY_SIZE + 4)
+    level = 0
+    while len(children) > 1:
+        parents = []
+        for i in range(0, len(children), max_keys + 1):
+            group = children[i:i + max_keys + 1]
+            data = b'II' + struct.pack('>Bii', level, len(group) - 1, group[0][1])
+            for key, block in group[1:]:
+                data += key + struct.pack('>i', block)
+            parents.append((group[0][0], len(blocks)))
+            blocks.append(data.ljust(BLOCK_SIZE, b'\x00'))
+        children = parents
+        level += 1
+    root = children[0][1]
+
+    header = b'SBBF02' + struct.pack('>ii?i', HEADER_SIZE, BLOCK_SIZE, False, -1)
+    header = header.ljust(32, b'\x00')
+    header += b'BTreeDB4'.ljust(12, b'\x00') + b'Test'.ljust(12, b'\x00')
+    header += struct.pack('>i?xi?xxxi?', KEY_SIZE, False, root, level == 0, root, level == 0)
+    return header.ljust(HEADER_SIZE, b'\x00') + b''.join(blocks)
+
+
+def make_key(number):
+    return struct.pack('>i', number)
+
+
+def make_value(number, length):
+    return bytes(bytearray((number + i) % 256 for i in range(length)))
+
+
+def make_leaves():
+    """Returns leaves with keys that are multiples of 10, so that there are
+    gaps between them for range bounds.
+
+    """
+    leaves = []
+    number = 10
+    for lengths in ([5, 7, 3], [200, 4], [1, 2, 3], [LEAF_DATA_SIZE * 4 + 17],
+                    [10, 10, 10], [6, 300, 8], [0, 1], [9, 9, 9], [12, 13]):
+        items = []
+        for length in lengths:
+            items.append((make_key(number), make_value(number, length)))
+            number += 10
+        leaves.append(items)
+
+    # A value that ends exactly at the end of its first block, followed by a
+    # key that starts in the next block. The leaf header, key and length
+    # prefix take 4, 4 and 1 bytes.
+    leaves.append([(make_key(1000), make_value(1000, LEAF_DATA_SIZE - 9)),
+                   (make_key(1010), make_value(1010, 5))])
+    # A value that spans several blocks and ends exactly at the end of the
+    # last one (the length prefix takes 2 bytes).
+    leaves.append([(make_key(1020), make_value(1020, LEAF_DATA_SIZE * 3 - 10))])
+    leaves.append([(make_key(1030), make_value(1030, 20))])
+    return leaves
+
+
+class BTreeDB4Test(unittest.TestCase):
+    use_mmap = False
+    thread_safe = False
+
+    def setUp(self):
+        self.leaves = make_leaves()
+        self.values = dict(item for items in self.leaves for item in items)
+        self.keys = sorted(self.values)
+
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(build_database(self.leaves))
+        self.db = self.open()
+
+    def tearDown(self):
+        self.db.close()
+        for path in (self.path, self.path + '.keyindex'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def open(self):
+        db = btreedb4.FileBTreeDB4(open(self.path, 'rb'))
+        db.use_mmap = self.use_mmap
+        db.thread_safe = self.thread_safe
+        db.initialize()
+        return db
+
+    def test_tree_shape(self):
+        # The tests below only mean something if the tree has index levels
+        # and the long values span several leaf blocks.
+        self.assertTrue(isinstance(self.db.get_block(self.db.root_node), btreedb4.BTreeIndex))
+        self.assertTrue(self.db.get_block(self.db.root_node).level > 0)
+        self.assertTrue(max(len(value) for value in self.values.values()) > LEAF_DATA_SIZE * 4)
+
+    def test_get_binary(self):
+        for key in self.keys:
+            value = self.db.get_binary(key)
+            self.assertTrue(isinstance(value, bytes))
+            self.assertEqual(value, self.values[key])
+        self.assertRaises(KeyError, self.db.get_binary, make_key(15))
+        self.assertRaises(KeyError, self.db.get_binary, make_key(5000))
+
+    def test_get_binary_chunks(self):
+        for key in self.keys:
+            chunks = list(self.db.get_binary_chunks(key))
+            self.assertEqual(b''.join(chunk.tobytes() for chunk in chunks), self.values[key])
+        self.assertTrue(len(list(self.db.get_binary_chunks(make_key(90)))) > 4)
+
+    def test_block_boundary(self):
+        for number in (1000, 1010, 1020, 1030):
+            key = make_key(number)
+            self.assertEqual(self.db.get_binary(key), self.values[key])
+        self.assertEqual(list(self.db.iter_keys(make_key(1000), make_key(1040))),
+                         [make_key(1000), make_key(1010), make_key(1020), make_key(1030)])
+
+    def test_iter_binary_items(self):
+        self.assertEqual(list(self.db.iter_binary_items()),
+                         [(key, self.values[key]) for key in self.keys])
+
+        # Bounds on keys, between keys and outside the range of keys.
+        bounds = [None, make_key(0), make_key(10), make_key(15), make_key(60), make_key(95),
+                  make_key(135), make_key(1005), make_key(1030), make_key(5000)]
+        for start in bounds:
+            for end in bounds:
+                expected = [key for key in self.keys
+                            if (start is None or key >= start) and (end is None or key < end)]
+                self.assertEqual(list(self.db.iter_keys(start, end)), expected)
+                self.assertEqual(list(self.db.iter_binary_items(start, end)),
+                                 [(key, self.values[key]) for key in expected])
+
+    def test_iter_binary_many(self):
+        keys = [make_key(90), make_key(15), make_key(10), make_key(1020), make_key(90)]
+        expected = [(key, self.values[key]) for key in sorted(set(keys)) if key in self.values]
+        self.assertEqual(list(self.db.iter_binary_many(keys)), expected)
+        self.assertEqual(self.db.get_binary_many(keys), dict(expected))
+
+    def test_key_index(self):
+        self.db.build_key_index()
+        for key in self.keys:
+            self.assertEqual(self.db.get_binary(key), self.values[key])
+        self.assertRaises(KeyError, self.db.get_binary, make_key(15))
+
+        db = self.open()
+        try:
+            self.assertTrue(db.load_key_index())
+            for key in self.keys:
+                self.assertEqual(db.get_binary(key), self.values[key])
+        finally:
+            db.close()
+
+        # A truncated sidecar is treated as stale and rebuilt.
+        with open(self.path + '.keyindex', 'rb') as f:
+            data = f.read()
+        with open(self.path + '.keyindex', 'wb') as f:
+            f.write(data[:-3])
+        db = self.open()
+        try:
+            self.assertFalse(db.load_key_index())
+            db.use_key_index()
+            self.assertTrue(db.load_key_index())
+        finally:
+            db.close()
+        with open(self.path + '.keyindex', 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_key_index_in_memory(self):
+        with open(self.path, 'rb') as f:
+            db = btreedb4.FileBTreeDB4(io.BytesIO(f.read()))
+        db.initialize()
+        self.assertFalse(db.load_key_index())
+        self.assertRaises(ValueError, db.build_key_index)
+
+    def test_small_cache(self):
+        self.db.block_cache = sbbf02.BlockCache(max_blocks=2)
+        for key in self.keys:
+            self.assertEqual(self.db.get_binary(key), self.values[key])
+        self.assertEqual(list(self.db.iter_binary_items()),
+                         [(key, self.values[key]) for key in self.keys])
+
+
+class MmapBTreeDB4Test(BTreeDB4Test):
+    use_mmap = True
+
+
+class ThreadSafeBTreeDB4Test(BTreeDB4Test):
+    thread_safe = True
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import io
+import random
+import struct
+import unittest
+
+from starbound import sbon
+
+
+# Values that need one, two and many bytes as varlen numbers.
+NUMBERS = [0, 1, 63, 64, 127, 128, 255, 16383, 16384, 2 ** 31 - 1, 2 ** 31, 2 ** 63, 2 ** 70 + 5]
+
+STRINGS = [u'', u'a', u'hello world', u'éè', u'☃ snow', u'x' * 200]
+
+
+def random_value(rng, depth=0):
+    """Returns a random dynamic value, with nested lists and maps up to a few
+    levels deep.
+
+    """
+    kind = rng.randint(0, 7 if depth < 4 else 5)
+    if kind == 0:
+        return None
+    elif kind == 1:
+        return rng.choice([0.0, -1.5, 3.25, 1e300, -2.5e-10, rng.uniform(-1e6, 1e6)])
+    elif kind == 2:
+        return rng.choice([True, False])
+    elif kind == 3:
+        return rng.choice([1, -1]) * rng.choice(NUMBERS)
+    elif kind in (4, 5):
+        return rng.choice(STRINGS)
+    elif kind == 6:
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 6))]
+    else:
+        return dict((rng.choice(STRINGS) + str(i), random_value(rng, depth + 1))
+                    for i in range(rng.randint(0, 6)))
+
+
+def random_tile(rng):
+    values = []
+    for code in sbon.TILE_FORMAT[1:]:
+        if code == '?':
+            values.append(rng.choice([True, False]))
+        else:
+            bits = struct.calcsize(code) * 8
+            if code.islower():
+                values.append(rng.randint(-2 ** (bits - 1), 2 ** (bits - 1) - 1))
+            else:
+                values.append(rng.randint(0, 2 ** bits - 1))
+    return sbon.Tile(*values)
+
+
+def plain_stream(data):
+    """Returns a stream without getbuffer, so that the read_* functions take
+    the stream path instead of decoding from the buffer.
+
+    """
+    return io.BufferedReader(io.BytesIO(bytes(data)))
+
+
+class RoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(1234)
+
+    def assert_dynamic(self, value):
+        data = bytes(sbon.encode_dynamic(value))
+        self.assertEqual(sbon.read_dynamic(io.BytesIO(data)), value)
+        self.assertEqual(sbon.read_dynamic(plain_stream(data)), value)
+        self.assertEqual(sbon.decode_dynamic(data), (value, len(data)))
+        lazy = sbon.read_dynamic(io.BytesIO(data), lazy=True)
+        self.assertEqual(sbon.materialize(lazy), value)
+        # Map order isn't kept by dicts on older Pythons, so compare the values.
+        self.assertEqual(sbon.decode_dynamic(sbon.encode_dynamic(lazy))[0], value)
+
+        stream = io.BytesIO()
+        sbon.write_dynamic(stream, value)
+        self.assertEqual(stream.getvalue(), data)
+
+    def test_dynamic(self):
+        for _ in range(500):
+            self.assert_dynamic(random_value(self.rng))
+
+    def test_nested_dynamic(self):
+        self.assert_dynamic({
+            u'name': u'test',
+            u'list': [1, -2, 3.5, None, True, [u'a', {u'b': []}]],
+            u'map': {u'empty': {}, u'deep': {u'deeper': {u'deepest': [2 ** 40]}}},
+        })
+
+    def test_document(self):
+        for _ in range(100):
+            document = sbon.Document(self.rng.choice(STRINGS), self.rng.randint(-5, 2 ** 31 - 1),
+                                     random_value(self.rng))
+            data = bytes(sbon.encode_document(document))
+            self.assertEqual(sbon.read_document(io.BytesIO(data)), document)
+            self.assertEqual(sbon.read_document(plain_stream(data)), document)
+            self.assertEqual(sbon.decode_document(data), (document, len(data)))
+
+            stream = io.BytesIO()
+            sbon.write_document(stream, document)
+            self.assertEqual(stream.getvalue(), data)
+
+    def test_document_list(self):
+        for _ in range(20):
+            documents = [sbon.Document(u'Entity%d' % i, i, random_value(self.rng))
+                         for i in range(self.rng.randint(0, 8))]
+            data = bytes(sbon.encode_document_list(documents))
+            self.assertEqual(sbon.read_document_list(io.BytesIO(data)), documents)
+            self.assertEqual(sbon.read_document_list(plain_stream(data)), documents)
+            self.assertEqual(sbon.decode_document_list(data), (documents, len(data)))
+
+            stream = io.BytesIO(data)
+            sbon.skip_document_list(stream)
+            self.assertEqual(stream.tell(), len(data))
+
+    def test_lazy_document(self):
+        document = sbon.Document(u'Test', 1, {u'list': [1, {u'a': [u'b']}], u'map': {u'c': 2.5}})
+        data = bytes(sbon.encode_document(document))
+        lazy = sbon.read_document(io.BytesIO(data), lazy=True)
+        self.assertEqual(sbon.decode_document(sbon.encode_document(lazy))[0], document)
+        self.assertEqual(sbon.decode_dynamic(sbon.encode_dynamic(lazy.data[u'list'][1:]))[0],
+                         [{u'a': [u'b']}])
+
+    def test_lazy_list_index(self):
+        lazy = sbon.decode_dynamic(sbon.encode_dynamic([1, 2, 3]), lazy=True)[0]
+        self.assertEqual([lazy[-1], lazy[-3]], [3, 1])
+        self.assertRaises(IndexError, lambda: lazy[3])
+        self.assertRaises(IndexError, lambda: lazy[-4])
+        self.assertRaises(IndexError, lambda: lazy[-5])
+
+    def test_tiles(self):
+        tiles = [random_tile(self.rng) for _ in range(100)]
+        buffer = bytearray()
+        for tile in tiles:
+            sbon.encode_tile(tile, buffer)
+        self.assertEqual(len(buffer), sbon.TILE_SIZE * len(tiles))
+
+        stream = plain_stream(buffer)
+        self.assertEqual([sbon.read_tile(stream) for _ in tiles], tiles)
+
+        stream = io.BytesIO()
+        for tile in tiles:
+            sbon.write_tile(stream, tile)
+        self.assertEqual(stream.getvalue(), bytes(buffer))
+
+    def test_varlen_number(self):
+        for value in NUMBERS:
+            data = bytes(sbon.encode_varlen_number(value))
+            self.assertEqual(sbon.read_varlen_number(plain_stream(data)), value)
+            self.assertEqual(sbon.decode_varlen_number(data), (value, len(data)))
+
+            stream = io.BytesIO()
+            sbon.write_varlen_number(stream, value)
+            self.assertEqual(stream.getvalue(), data)
+
+        self.assertEqual(bytes(sbon.encode_varlen_number(127)), b'\x7f')
+        self.assertEqual(bytes(sbon.encode_varlen_number(128)), b'\x81\x00')
+        self.assertEqual(bytes(sbon.encode_varlen_number(16384)), b'\x81\x80\x00')
+        self.assertRaises(ValueError, sbon.encode_varlen_number, -1)
+
+    def test_varlen_numbers(self):
+        buffer = bytearray()
+        for value in NUMBERS:
+            sbon.encode_varlen_number(value, buffer)
+        self.assertEqual(sbon.decode_varlen_numbers(buffer, len(NUMBERS)),
+                         (NUMBERS, len(buffer)))
+
+    def test_varlen_number_signed(self):
+        for value in NUMBERS + [-value for value in NUMBERS]:
+            data = bytes(sbon.encode_varlen_number_signed(value))
+            self.assertEqual(sbon.read_varlen_number_signed(plain_stream(data)), value)
+            self.assertEqual(sbon.decode_varlen_number_signed(data), (value, len(data)))
+
+            stream = io.BytesIO()
+            sbon.write_varlen_number_signed(stream, value)
+            self.assertEqual(stream.getvalue(), data)
+
+        # The least significant bit is the sign.
+        self.assertEqual(bytes(sbon.encode_varlen_number_signed(1)), b'\x02')
+        self.assertEqual(bytes(sbon.encode_varlen_number_signed(-1)), b'\x03')
+        self.assertEqual(bytes(sbon.encode_varlen_number_signed(-64)), b'\x81\x01')
+
+
+if __name__ == '__main__':
+    unittest.main()